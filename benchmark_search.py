@@ -0,0 +1,78 @@
+import os
+import copy
+import time
+import yaml
+import torch
+import argparse
+
+from database import RAGKnowledgeBase
+
+
+def run_queries(knowledge_base, queries, topk):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        _, metas, _ = knowledge_base.get_topk(query, topk=topk, threshold=-1.0)
+        results.append(metas)
+    latency = (time.perf_counter() - start) / len(queries)
+    return results, latency
+
+
+def get_recall(results, exact_results):
+    recalls = [len(set(result) & set(exact)) / max(len(exact), 1) for result, exact in zip(results, exact_results)]
+    return sum(recalls) / len(recalls)
+
+
+def main(args):
+    # load config
+    with open(args.config_path, 'r') as file:
+        config = yaml.safe_load(file)
+
+    # init api key
+    if "OPENAI_API_KEY" not in os.environ:
+        os.environ["OPENAI_API_KEY"] = config['API_KEY']
+
+    root_path = config[args.source]['ROOT_PATH']
+    exact_config = copy.deepcopy(config)
+    exact_config['SEARCH'].update({'ANN': 'none', 'QUANTIZE': False, 'PREFIX_DIM': 0})
+    exact_base = RAGKnowledgeBase(exact_config, root_path)
+    exact_base.ensure_loaded()
+
+    # queries are stored chunk embeddings with gaussian noise, so no embedding requests are needed
+    generator = torch.Generator().manual_seed(args.seed)
+    rows = torch.randint(exact_base.offsets[-1], (args.num_queries,), generator=generator)
+    embeddings = exact_base.get_rows(rows).cpu()
+    queries = [embedding + args.noise * torch.randn(embedding.shape[0], generator=generator) for embedding in embeddings]
+
+    exact_results, exact_latency = run_queries(exact_base, queries, args.topk)
+    print(f"====="*10)
+    print(f"exact search: {exact_base.offsets[-1]} items, {exact_latency * 1000:.2f} ms/query")
+
+    # nprobe for ivf, ef for hnsw, candidate multiplier for the int8 scan
+    param_name = {'ivf': 'IVF_NPROBE', 'hnsw': 'HNSW_EF', 'int8': 'CANDIDATE_MULTIPLIER'}[args.ann]
+    for param in args.params:
+        ann_config = copy.deepcopy(config)
+        if args.ann == 'int8':
+            ann_config['SEARCH'].update({'ANN': 'none', 'QUANTIZE': True, param_name: param})
+        else:
+            ann_config['SEARCH'].update({'ANN': args.ann, param_name: param})
+        ann_base = RAGKnowledgeBase(ann_config, root_path)
+        # load outside the timed queries, lazy loading would be counted in the first query
+        ann_base.ensure_loaded()
+        results, latency = run_queries(ann_base, queries, args.topk)
+        print(f"====="*10)
+        print(f"{args.ann} search ({param_name}={param}): recall@{args.topk} {get_recall(results, exact_results):.3f}, {latency * 1000:.2f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark approximate search against exact search")
+    parser.add_argument('--config_path', type=str, default='./configs/config.yaml', help='config path')
+    parser.add_argument('--source', type=str, default='DATABASE', choices=['DATABASE', 'DICTIONARY'], help='which knowledge base to benchmark')
+    parser.add_argument('--num_queries', type=int, default=200, help='number of random queries')
+    parser.add_argument('--noise', type=float, default=0.01, help='std of gaussian noise added to query embeddings')
+    parser.add_argument('--topk', type=int, default=5, help='top k items for recall')
+    parser.add_argument('--ann', type=str, default='ivf', choices=['ivf', 'hnsw', 'int8'], help='approximate index or int8 scan to benchmark')
+    parser.add_argument('--params', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='ivf nprobe, hnsw ef or int8 candidate multiplier values to test')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
@@ -6,6 +6,10 @@ from openai import OpenAI
 import torch.nn.functional as F
 
 from prompts import *
+from utils.rate_limiter import get_rate_limiter, estimate_tokens
+
+# estimated completion tokens of one reply, used for the tokens per minute limit
+COMPLETION_TOKENS = 1000
 
 class InvalidAPIKeyError(Exception):
     pass
@@ -14,6 +18,7 @@ class ChatBot():
     def __init__(self, config):
         self.config = config
         self.client = OpenAI()
+        self.rate_limiter = get_rate_limiter(config, 'QA_MODEL')
         self.history = []
         self.refine_history = []
         # add history path and history name
@@ -24,6 +29,11 @@ class ChatBot():
         self.refine_history_path = os.path.join(self.config['CHATBOT']['HISTORY_PATH'], self.chat_name + '_refine.json')
         
 
+    def create_completion(self, **kwargs):
+        # wait for the requests per minute (RPM) and tokens per minute (TPM) budget of the QA model, backs off on 429
+        tokens = sum(estimate_tokens(str(message['content'])) for message in kwargs['messages']) + COMPLETION_TOKENS
+        return self.rate_limiter.call(self.client.chat.completions.create, tokens=tokens, **kwargs)
+
     def clear_history(self):
         print(f"==> Delete {len(self.history)} items in history")
         self.history = []
@@ -57,7 +67,7 @@ class ChatBot():
             prompt += f"\n\nREFERENCE:\n{phrase_content}"
         messages.append({"role": "user", "content": prompt})
 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=messages
@@ -87,7 +97,7 @@ class ChatBot():
         # add user input
         self.update_history("user", prompt, self.config['MODEL_TYPES']['QA_MODEL'])
 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=self.history
@@ -111,7 +121,7 @@ class ChatBot():
         # add user input
         self.update_history("user", prompt, self.config['MODEL_TYPES']['QA_MODEL'])
 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=self.history
@@ -131,7 +141,7 @@ class ChatBot():
         # add user input
         self.update_history("user", prompt, self.config['MODEL_TYPES']['QA_MODEL'])
 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=self.history
@@ -154,7 +164,7 @@ class ChatBot():
         # add user input
         self.update_history("user", prompt, self.config['MODEL_TYPES']['QA_MODEL'])
 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=self.history
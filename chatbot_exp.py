@@ -7,6 +7,10 @@ import torch.nn.functional as F
 
 # 默认导入 prompts_exp，但可以通过 persona_module 覆盖
 from prompts_exp import *
+from utils.rate_limiter import get_rate_limiter, estimate_tokens
+
+# estimated completion tokens of one reply, used for the tokens per minute limit
+COMPLETION_TOKENS = 1000
 
 class InvalidAPIKeyError(Exception):
     pass
@@ -15,6 +19,7 @@ class ChatBot():
     def __init__(self, config):
         self.config = config
         self.client = OpenAI()
+        self.rate_limiter = get_rate_limiter(config, 'QA_MODEL')
         self.history = []
         self.refine_history = []
         self.persona_module = None  # 用于存储当前选择的 persona 模块
@@ -37,6 +42,11 @@ class ChatBot():
             # 使用默认的 prompts_exp
             return globals().get(prompt_name, "")
 
+    def create_completion(self, **kwargs):
+        # wait for the requests per minute (RPM) and tokens per minute (TPM) budget of the QA model, backs off on 429
+        tokens = sum(estimate_tokens(str(message['content'])) for message in kwargs['messages']) + COMPLETION_TOKENS
+        return self.rate_limiter.call(self.client.chat.completions.create, tokens=tokens, **kwargs)
+
     def clear_history(self):
         print(f"==> Delete {len(self.history)} items in history")
         self.history = []
@@ -72,7 +82,7 @@ class ChatBot():
             prompt += f"\n\nREFERENCE:\n{phrase_content}"
         messages.append({"role": "user", "content": prompt})
 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=messages
@@ -112,7 +122,7 @@ class ChatBot():
         )
         self.update_history("user", prompt, self.config['MODEL_TYPES']['QA_MODEL'])
 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=self.history
@@ -140,7 +150,7 @@ class ChatBot():
         # add user input
         self.update_history("user", prompt, self.config['MODEL_TYPES']['QA_MODEL']) 
 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=self.history
@@ -173,7 +183,7 @@ class ChatBot():
             prompt += f"\n\nDICTIONARY REFERENCE:\n{dict_content}"
         # add user input
         self.update_history("user", prompt, self.config['MODEL_TYPES']['QA_MODEL']) 
-        completion = self.client.chat.completions.create(
+        completion = self.create_completion(
             model=self.config['MODEL_TYPES']['QA_MODEL'],
             temperature=0.5,
             messages=self.history
@@ -1,16 +1,157 @@
 import os
+import time
+import bisect
+import threading
 import torch
+import openai
 from openai import OpenAI
 import torch.nn.functional as F
 
+from utils.embedding_cache import EmbeddingLRUCache, get_persistent_cache
+from utils.index_format import has_index, load_index, read_header, HEADER_NAME as INDEX_HEADER_NAME
+from utils.quantization import quantize_int8, int8_scores
+from utils.ann_index import IVFIndex
+from utils.hnsw_index import HNSWIndex
+from utils.bm25 import BM25Index
+from utils.term_index import TermIndex, load_raw_dict
+
+# process-wide registry of loaded sources keyed by (path, mtime, device, bm25, dtype),
+# every knowledge base over the same files shares one read-only copy of their tensors
+_SOURCE_REGISTRY = {}
+# one compiled matrix per device over every shared source, knowledge bases scan slices of it
+_COMPILED_SOURCES = {}
+_REGISTRY_LOCK = threading.Lock()
+_CLIENTS = {}
+# after an embedding request fails, skip the api until retry_at so a turn never waits on it twice
+_EMBED_STATE = {'retry_at': 0.0}
+
+
+class EmbeddingUnavailableError(Exception):
+    pass
+
+
+def get_openai_client():
+    # one client per api key, the streamlit apps can switch keys at runtime
+    api_key = os.environ.get("OPENAI_API_KEY")
+    with _REGISTRY_LOCK:
+        if api_key not in _CLIENTS:
+            _CLIENTS[api_key] = OpenAI()
+        return _CLIENTS[api_key]
+
+
+def load_source(database_path, device, with_bm25=False, dtype=None):
+    database_folder = os.path.dirname(database_path)
+    if has_index(database_folder):
+        # memory-mapped index, near-zero load time and pages are shared between processes
+        source = load_index(database_folder)
+        source['embedding'] = torch.from_numpy(source['embedding'])
+        source['mapped'] = True
+    else:
+        source = torch.load(database_path, weights_only=False, map_location=device)
+        source['mapped'] = False
+    # Move embeddings to the appropriate device
+    source['embedding'] = source['embedding'].to(device)
+    # normalize once here instead of on every query
+    if not source.get('normalized', False):
+        source['embedding'] = F.normalize(source['embedding'].float(), dim=-1)
+        source['normalized'] = True
+    # smaller in-memory copy of .pth sources, e.g. float16 rows for rescoring int8 candidates
+    if dtype is not None and not source['mapped']:
+        source['embedding'] = source['embedding'].to(dtype)
+    # lexical index built at ingestion time, older files get one built here
+    if with_bm25:
+        source['bm25'] = BM25Index.load(database_folder)
+        if source['bm25'] is None or source['bm25'].count != source['embedding'].shape[0]:
+            source['bm25'] = BM25Index.build(source['content'])
+    return source
+
+
+def load_shared_source(database_path, device, with_bm25=False, dtype=None):
+    database_folder = os.path.dirname(database_path)
+    source_path = os.path.abspath(os.path.join(database_folder, INDEX_HEADER_NAME) if has_index(database_folder) else database_path)
+    key = (source_path, os.path.getmtime(source_path), str(device), with_bm25, str(dtype))
+    with _REGISTRY_LOCK:
+        if key not in _SOURCE_REGISTRY:
+            # drop copies of older versions of the same file
+            for stale_key in [k for k in _SOURCE_REGISTRY if k[0] == key[0] and k[1] != key[1]]:
+                _SOURCE_REGISTRY.pop(stale_key)
+            _SOURCE_REGISTRY[key] = load_source(database_path, device, with_bm25=with_bm25, dtype=dtype)
+            _SOURCE_REGISTRY[key]['shared_key'] = key
+        else:
+            print(f"==> Reuse shared copy of {database_folder}")
+        return _SOURCE_REGISTRY[key]
+
+
+def compile_shared_sources(source_keys, device):
+    # append missing shared sources to the compiled matrix of the device, returns (matrix, row ranges, version)
+    with _REGISTRY_LOCK:
+        compiled = _COMPILED_SOURCES.setdefault(str(device), {'matrix': None, 'ranges': {}, 'version': 0})
+        live_keys = [key for key in compiled['ranges'] if key in _SOURCE_REGISTRY]
+        missing_keys = [key for key in source_keys if key not in compiled['ranges'] and key in _SOURCE_REGISTRY]
+        if len(missing_keys) > 0 or len(live_keys) < len(compiled['ranges']):
+            # recompile once with new sources appended and older versions of updated files dropped
+            blocks = [compiled['matrix'][slice(*compiled['ranges'][key])] for key in live_keys]
+            blocks += [_SOURCE_REGISTRY[key]['embedding'].float().to(device) for key in missing_keys]
+            matrix = torch.cat(blocks, dim=0).contiguous()
+            ranges = {}
+            start = 0
+            for key, block in zip(live_keys + missing_keys, blocks):
+                ranges[key] = (start, start + block.shape[0])
+                # the one shared tensor of a source is its slice of the compiled matrix
+                _SOURCE_REGISTRY[key].update({'embedding': matrix[start:start + block.shape[0]], 'normalized': True, 'mapped': False})
+                start += block.shape[0]
+            compiled.update({'matrix': matrix, 'ranges': ranges, 'version': compiled['version'] + 1})
+            print(f"==> Compile {len(ranges)} shared sources into one matrix")
+        return compiled['matrix'], dict(compiled['ranges']), compiled['version']
+
+
 class RAGKnowledgeBase():
     def __init__(self, config, root_path, database_names=None):
         if database_names is None:
-            database_names = os.listdir(root_path)
+            # hidden folders hold file versions of update_database.py, the visible links point to the current ones
+            database_names = [name for name in os.listdir(root_path) if os.path.isdir(os.path.join(root_path, name)) and not name.startswith('.')]
         self.database = {}
         self.datanames = []
+        # registered sources, they are only loaded on first query (or by the background prefetch)
+        self.manifest = {}
+        self.loaded = True
+        self.load_lock = threading.RLock()
+        # all sources compiled into one L2-normalized matrix, rows of source i are offsets[i]:offsets[i+1]
+        self.embedding_matrix = None
+        self.embedding_blocks = []
+        self.offsets = [0]
         self.config = config
-        self.client = OpenAI()
+        # optional int8 and/or truncated (matryoshka) copy for a coarse scan, candidates are rescored in full precision
+        self.quantize = self.config['SEARCH'].get('QUANTIZE', False)
+        self.prefix_dim = self.config['SEARCH'].get('PREFIX_DIM', 0)
+        self.candidate_multiplier = self.config['SEARCH'].get('CANDIDATE_MULTIPLIER', 10)
+        # optional approximate nearest neighbour index per source, built at ingestion time
+        self.ann = self.config['SEARCH'].get('ANN', 'none')
+        self.quantized_codes = None
+        self.quantized_scale = None
+        self.prefix_embeddings = None
+        self.share_sources = self.config['SEARCH'].get('SHARE_SOURCES', False)
+        # version of the shared compiled matrix this knowledge base holds slices of
+        self.shared_version = None
+        # bm25 lexical search, fused with vector search and/or used when the embedding request fails
+        self.hybrid = self.config['SEARCH'].get('HYBRID', False)
+        self.lexical_fallback = self.config['SEARCH'].get('LEXICAL_FALLBACK', False)
+        self.rrf_k = self.config['SEARCH'].get('RRF_K', 60)
+        # exact term lookup over the raw dictionaries of the sources, e.g. acronyms in the user utterance
+        self.exact_match = self.config['SEARCH'].get('EXACT_MATCH', False)
+        self.exact_match_only = self.config['SEARCH'].get('EXACT_MATCH_ONLY', False)
+        self.exact_topk = self.config['SEARCH'].get('EXACT_TOPK', 3)
+        # catch phrases and end words are checked by the phrase matcher, their definitions would come up on every turn
+        self.exact_skip_sources = self.config.get('REFINE_KNOWLEDGE', {}).get('PHRASE_NAME', [])
+        self.exact_skip_terms = {tuple(phrase.lower().split()) for phrase in self.config.get('REFINE_KNOWLEDGE', {}).get('END_PHRASES', [])}
+        self.term_index = None
+        self.client = get_openai_client() if self.share_sources else OpenAI()
+        # cache query embeddings, trainees repeat the same radio phrases a lot
+        cache_config = self.config.get('EMBED_CACHE', {})
+        self.embed_cache = EmbeddingLRUCache(max_entries=cache_config.get('MAX_ENTRIES', 1024),
+                                             ttl=cache_config.get('TTL', 3600))
+        # shared on-disk cache, survives restarts and is shared between streamlit workers
+        self.disk_cache = get_persistent_cache(self.config)
         
         # Check if CUDA is available, otherwise use CPU
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -18,66 +159,347 @@ class RAGKnowledgeBase():
         
         for name in database_names:
             database_path = os.path.join(root_path, name, 'contents_with_embed.pth')
-            self.add_knowledge(name, database_path)
+            self.register_knowledge(name, database_path)
+        if not self.config['SEARCH'].get('LAZY_LOAD', False):
+            self.ensure_loaded()
+        elif self.config['SEARCH'].get('PREFETCH', False):
+            threading.Thread(target=self.ensure_loaded, daemon=True).start()
+
+    def register_knowledge(self, name, database_path):
+        # only read the lightweight header, the embeddings are loaded by ensure_loaded
+        database_folder = os.path.dirname(database_path)
+        if has_index(database_folder):
+            entry = {'path': database_path, 'format': 'mmap', 'count': read_header(database_folder)['count']}
+        elif os.path.exists(database_path):
+            entry = {'path': database_path, 'format': 'pth', 'count': None}
+        else:
+            raise FileNotFoundError(f"No processed file for {name}: {database_path}")
+        with self.load_lock:
+            self.manifest[name] = entry
+            self.loaded = False
+        print(f"==> Register processed file for database: {name}")
+
+    def ensure_loaded(self):
+        # materialize all registered sources that are not loaded yet,
+        # and move to the new shared matrix after another knowledge base recompiled it
+        if self.loaded and not self.shared_outdated():
+            return
+        with self.load_lock:
+            if self.loaded and not self.shared_outdated():
+                return
+            for name in [name for name in self.manifest if name not in self.database]:
+                self.add_knowledge(name, self.manifest[name]['path'], build=False)
+                print(f"==> Load processed file into database: {name}")
+            self.build_index()
+            self.loaded = True
+
+    def shared_outdated(self):
+        return self.shared_version is not None and _COMPILED_SOURCES[str(self.device)]['version'] != self.shared_version
+
+    def add_knowledge(self, name, database_path, build=True):
+        database_folder = os.path.dirname(database_path)
+        # with int8 codes for the coarse scan, the rows are only read for rescoring and float16 is enough
+        dtype = torch.float16 if self.quantize else None
+        if self.share_sources:
+            # own dict over shared tensors, the shared source itself is never modified
+            self.database[name] = dict(load_shared_source(database_path, self.device, with_bm25=self.hybrid or self.lexical_fallback, dtype=dtype))
+        else:
+            self.database[name] = load_source(database_path, self.device, with_bm25=self.hybrid or self.lexical_fallback, dtype=dtype)
+        self.database[name]['ann'] = self.load_ann_index(name, database_folder)
+        if name not in self.manifest:
+            self.manifest[name] = {'path': database_path, 'format': 'mmap' if self.database[name].get('mapped', False) else 'pth',
+                                   'count': self.database[name]['embedding'].shape[0]}
+        if name not in self.datanames:
             self.datanames.append(name)
-            print(f"==> Load processed file into database: {name}")        
+        if build:
+            with self.load_lock:
+                self.build_index()
 
-    def add_knowledge(self, name, database_path):
-        self.database[name] = torch.load(database_path, weights_only=False, map_location=self.device)
-        # Move embeddings to the appropriate device
-        self.database[name]['embedding'] = self.database[name]['embedding'].to(self.device)
+    def load_ann_index(self, name, database_folder):
+        # "auto" uses whichever index was built for the source, hnsw first
+        if self.ann == 'none':
+            return None
+        ann_index = None
+        if self.ann in ['hnsw', 'auto']:
+            ann_index = HNSWIndex.load(database_folder, ef=self.config['SEARCH'].get('HNSW_EF', 64))
+        if ann_index is None and self.ann in ['ivf', 'auto']:
+            ann_index = IVFIndex.load(database_folder, nprobe=self.config['SEARCH'].get('IVF_NPROBE', 8))
+        if ann_index is None or ann_index.count != self.database[name]['embedding'].shape[0]:
+            print(f"==> No valid {self.ann} index for {name}, use exact search for this source")
+            return None
+        return ann_index
 
     def remove_knowledge(self, name):
-        self.database.pop(name)
+        with self.load_lock:
+            self.manifest.pop(name)
+            if name in self.database:
+                self.database.pop(name)
+                self.datanames.remove(name)
+                self.build_index()
+
+    def build_index(self):
+        self.offsets = [0]
+        self.embedding_matrix = None
+        self.embedding_blocks = []
+        self.quantized_codes = None
+        self.quantized_scale = None
+        self.prefix_embeddings = None
+        self.shared_version = None
+        # memory-mapped sources on cpu are scanned in place, a compiled copy would duplicate pages shared between processes,
+        # with int8 codes no float32 copy is compiled either, candidates are rescored from the source rows through get_rows
+        in_place = self.quantize or (self.device.type == 'cpu' and all(self.database[name].get('mapped', False) for name in self.datanames))
+        shared_ranges = None
+        if not in_place and self.share_sources and all('shared_key' in self.database[name] for name in self.datanames):
+            shared_matrix, shared_ranges, self.shared_version = compile_shared_sources([self.database[name]['shared_key'] for name in self.datanames], self.device)
+            # same order as the shared matrix, so a base over a contiguous run of sources scans one slice of it,
+            # a source whose file was updated meanwhile is not in the matrix and keeps its own tensor
+            self.datanames.sort(key=lambda name: shared_ranges.get(self.database[name]['shared_key'], (float('inf'),))[0])
+            for name in self.datanames:
+                if self.database[name]['shared_key'] in shared_ranges:
+                    start, end = shared_ranges[self.database[name]['shared_key']]
+                    self.database[name].update({'embedding': shared_matrix[start:end], 'normalized': True, 'mapped': False})
+        for name in self.datanames:
+            embedding = self.database[name]['embedding']
+            self.embedding_blocks.append(embedding)
+            self.offsets.append(self.offsets[-1] + embedding.shape[0])
+        if self.exact_match:
+            raw_dicts = {name: load_raw_dict(os.path.dirname(self.manifest[name]['path'])) for name in self.datanames if name not in self.exact_skip_sources}
+            self.term_index = TermIndex.build({name: raw_dict for name, raw_dict in raw_dicts.items() if raw_dict is not None}, skip_terms=self.exact_skip_terms)
+        if len(self.embedding_blocks) == 0:
+            return
+        coarse_blocks = self.embedding_blocks
+        if 0 < self.prefix_dim < self.embedding_blocks[0].shape[1]:
+            # text-embedding-3 vectors can be truncated to a prefix and renormalized
+            coarse_blocks = [F.normalize(block[:, :self.prefix_dim].float(), dim=-1) for block in self.embedding_blocks]
+            if not self.quantize:
+                self.prefix_embeddings = torch.cat(coarse_blocks, dim=0).to(self.device).contiguous()
+        if self.quantize:
+            self.quantized_codes, self.quantized_scale = quantize_int8(coarse_blocks)
+            self.quantized_codes = self.quantized_codes.to(self.device)
+            self.quantized_scale = self.quantized_scale.to(self.device)
+        if shared_ranges is not None:
+            # sources of a contiguous run are scanned as one slice, otherwise the source slices one by one
+            if all(self.database[name]['shared_key'] in shared_ranges for name in self.datanames):
+                start, end = shared_ranges[self.database[self.datanames[0]]['shared_key']][0], shared_ranges[self.database[self.datanames[-1]]['shared_key']][1]
+                if end - start == self.offsets[-1]:
+                    self.embedding_matrix = shared_matrix[start:end]
+        elif not in_place:
+            # compile all sources into one contiguous matrix
+            self.embedding_matrix = torch.cat([block.float() for block in self.embedding_blocks], dim=0).to(self.device).contiguous()
+            # keep per-source embeddings as views of the matrix so the vectors are only stored once
+            self.embedding_blocks = []
+            for i, name in enumerate(self.datanames):
+                self.database[name]['embedding'] = self.embedding_matrix[self.offsets[i]:self.offsets[i + 1]]
+                self.database[name]['normalized'] = True
+                self.database[name]['mapped'] = False
+                self.embedding_blocks.append(self.database[name]['embedding'])
+        # graph indexes compute similarities on the final normalized vectors
+        for i, name in enumerate(self.datanames):
+            ann_index = self.database[name].get('ann')
+            if isinstance(ann_index, HNSWIndex):
+                ann_index.attach(self.embedding_blocks[i].cpu().numpy())
+
+    def get_similarity(self, input_embed):
+        # cosine similarity between a normalized query and every row of all sources
+        if self.embedding_matrix is not None:
+            return torch.mv(self.embedding_matrix, input_embed)
+        return torch.cat([torch.mv(block, input_embed.to(block.dtype)).float() for block in self.embedding_blocks], dim=0)
+
+    def get_rows(self, indices):
+        # gather full precision rows for global indices, memory-mapped sources only touch the needed pages
+        self.ensure_loaded()
+        if self.embedding_matrix is not None:
+            return self.embedding_matrix[indices]
+        rows = torch.empty(indices.shape[0], self.embedding_blocks[0].shape[1], device=self.device)
+        source_ids = torch.bucketize(indices.cpu(), torch.tensor(self.offsets[1:]), right=True)
+        for source_id in source_ids.unique().tolist():
+            mask = source_ids == source_id
+            local_indices = indices.cpu()[mask] - self.offsets[source_id]
+            rows[mask.to(self.device)] = self.embedding_blocks[source_id][local_indices.to(self.embedding_blocks[source_id].device)].float().to(self.device)
+        return rows
+
+    def get_candidates(self, input_embed, topk):
+        # coarse candidate indices for rescoring, None means run the exact scan
+        num_candidates = topk * self.candidate_multiplier
+        if num_candidates >= self.offsets[-1]:
+            return None
+        if any(self.database[name].get('ann') is not None for name in self.datanames):
+            return self.get_ann_candidates(input_embed, num_candidates)
+        if self.quantized_codes is None and self.prefix_embeddings is None:
+            return None
+        if 0 < self.prefix_dim < input_embed.shape[0]:
+            input_embed = F.normalize(input_embed[:self.prefix_dim], dim=-1)
+        if self.quantized_codes is not None:
+            scores = int8_scores(self.quantized_codes, input_embed * self.quantized_scale)
+        else:
+            scores = torch.mv(self.prefix_embeddings, input_embed)
+        return torch.topk(scores, k=num_candidates, largest=True).indices
+
+    def get_ann_candidates(self, input_embed, num_candidates):
+        # union of the ann candidates of every source, sources without index contribute all of their rows
+        candidates = []
+        for i, name in enumerate(self.datanames):
+            ann_index = self.database[name].get('ann')
+            if ann_index is None:
+                local_indices = torch.arange(self.offsets[i + 1] - self.offsets[i])
+            else:
+                local_indices = ann_index.search(input_embed, num_candidates)
+            candidates.append(local_indices.cpu() + self.offsets[i])
+        return torch.cat(candidates, dim=0).to(self.device)
+
+    def locate(self, index):
+        # map a row of the compiled matrix back to (source name, row inside that source)
+        source_id = bisect.bisect_right(self.offsets, index) - 1
+        return self.datanames[source_id], index - self.offsets[source_id]
 
     def get_embeddings(self, text):
-        embeddings = self.client.embeddings.create(
-                    model=self.config['MODEL_TYPES']['TEXT_EMBED_MODEL'],
-                    input=text,
-                    encoding_format="float"
-                    )
-        return embeddings.data[0].embedding
+        model_type = self.config['MODEL_TYPES']['TEXT_EMBED_MODEL']
+        embedding = self.embed_cache.get(model_type, text)
+        if embedding is not None:
+            return embedding
+        if self.disk_cache is not None:
+            embedding = self.disk_cache.get(model_type, text)
+            if embedding is not None:
+                self.embed_cache.put(model_type, text, embedding)
+                return embedding
+        if not self.lexical_fallback:
+            # without a fallback the request keeps the client's own retries
+            client = self.client.with_options(timeout=self.config['SEARCH']['EMBED_TIMEOUT']) if self.config['SEARCH'].get('EMBED_TIMEOUT') else self.client
+            embeddings = client.embeddings.create(model=model_type, input=text, encoding_format="float")
+        else:
+            if time.monotonic() < _EMBED_STATE['retry_at']:
+                raise EmbeddingUnavailableError("embedding request failed recently, skip it for now")
+            # fail fast, one attempt bounded by EMBED_TIMEOUT, the turn falls back to lexical search
+            client = self.client.with_options(timeout=self.config['SEARCH'].get('EMBED_TIMEOUT') or openai.DEFAULT_TIMEOUT, max_retries=0)
+            try:
+                embeddings = client.embeddings.create(model=model_type, input=text, encoding_format="float")
+            except (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError) as e:
+                _EMBED_STATE['retry_at'] = time.monotonic() + self.config['SEARCH'].get('EMBED_RETRY_AFTER', 30)
+                raise EmbeddingUnavailableError(str(e)) from e
+        embedding = embeddings.data[0].embedding
+        self.embed_cache.put(model_type, text, embedding)
+        if self.disk_cache is not None:
+            self.disk_cache.put(model_type, text, embedding)
+        return embedding
 
-    def get_topk(self, input_embed, topk=5, threshold=0.1):
-        selected_scores = []
-        selected_metas = []
-        selected_contents = []
-        # local search file one by one
-        for name in self.datanames:
-            similarity = F.cosine_similarity(input_embed, self.database[name]['embedding'], dim=-1)
-            values, indices = torch.topk(similarity, k=topk, largest=True)
-            selected_scores.append(values)
-            for index in indices.tolist():
-                selected_metas.append(str(self.database[name]['meta'][index]))
-                selected_contents.append(str(self.database[name]['content'][index]))
-
-        # global combine all results and get final topk
+    def get_query_embedding(self, text):
+        # embed once and pass the result to search_knowledge of every knowledge base that shares the embed model
+        # returns None if the request failed and lexical fallback is enabled
+        try:
+            input_embed = self.get_embeddings(text)
+        except EmbeddingUnavailableError as e:
+            if not self.lexical_fallback:
+                raise
+            print(f"==> Embedding unavailable ({e}), fall back to lexical search")
+            return None
+        return torch.FloatTensor(input_embed).unsqueeze(0).to(self.device)
+
+    def get_dense_ranking(self, input_embed, topk):
+        # (scores, global indices) of the best topk rows for a query embedding, best first
+        input_embed = F.normalize(input_embed.reshape(-1).float(), dim=-1)
+        candidates = self.get_candidates(input_embed, topk)
+        if candidates is None:
+            # one matrix-vector product over all sources, rows are already normalized
+            similarity = self.get_similarity(input_embed)
+            values, indices = torch.topk(similarity, k=min(topk, similarity.shape[0]), largest=True)
+        elif candidates.shape[0] == 0:
+            return [], []
+        else:
+            # rescore coarse candidates in full precision before threshold and topk
+            similarity = torch.mv(self.get_rows(candidates), input_embed)
+            values, order = torch.topk(similarity, k=min(topk, similarity.shape[0]), largest=True)
+            indices = candidates[order]
+        return values.tolist(), indices.tolist()
+
+    def get_lexical_ranking(self, text, topk):
+        # (score, global index) pairs of the best bm25 matches over all sources, best first
+        # bm25 statistics are per source, good enough to merge rankings of similar sized sources
+        results = []
+        for i, name in enumerate(self.datanames):
+            bm25 = self.database[name].get('bm25')
+            if bm25 is None:
+                continue
+            scores, indices = bm25.search(text, topk)
+            results.extend((score, self.offsets[i] + index) for score, index in zip(scores, indices))
+        results.sort(key=lambda item: item[0], reverse=True)
+        return results[:topk]
+
+    def get_results(self, ranked):
         final_scores = []
         final_metas = []
         final_contents = []
-        global_similarity = torch.cat(selected_scores, dim=0)
-        values, indices = torch.topk(global_similarity, k=topk, largest=True)
-        for index, score in zip(indices.tolist(), values.tolist()):
-            if score > threshold:
-                final_scores.append(score)
-                final_metas.append(selected_metas[index])
-                final_contents.append(selected_contents[index])
+        for index, score in ranked:
+            name, local_index = self.locate(index)
+            final_scores.append(score)
+            final_metas.append(str(self.database[name]['meta'][local_index]))
+            final_contents.append(str(self.database[name]['content'][local_index]))
         return final_scores, final_metas, final_contents
 
-        
-    def search_knowledge(self, input, prefix="RAG", topk=5):
-        # get input embedding
-        input_embed = self.get_embeddings(input)
-        input_embed = torch.FloatTensor(input_embed).unsqueeze(0).to(self.device)
+    def get_topk(self, input_embed, topk=5, threshold=0.1):
+        self.ensure_loaded()
+        if self.offsets[-1] == 0:
+            return [], [], []
+        values, indices = self.get_dense_ranking(input_embed, topk)
+        return self.get_results([(index, score) for index, score in zip(indices, values) if score > threshold])
+
+    def get_lexical_topk(self, text, topk=5):
+        self.ensure_loaded()
+        return self.get_results([(index, score) for score, index in self.get_lexical_ranking(text, topk)])
+
+    def get_exact_topk(self, text, topk=5):
+        # dictionary items whose term appears verbatim in the text, scored 1.0
+        self.ensure_loaded()
+        if self.term_index is None:
+            return [], [], []
+        hits = [(name, index) for name, index in self.term_index.lookup(text) if index < len(self.database[name]['content'])]
+        return self.get_results([(self.offsets[self.datanames.index(name)] + index, 1.0) for name, index in hits[:topk]])
+
+    def get_hybrid_topk(self, text, input_embed, topk=5, threshold=0.1):
+        # reciprocal rank fusion of the vector ranking (above threshold) and the bm25 ranking
+        self.ensure_loaded()
+        if self.offsets[-1] == 0:
+            return [], [], []
+        num_candidates = topk * self.candidate_multiplier
+        values, indices = self.get_dense_ranking(input_embed, num_candidates)
+        dense_ranking = [index for index, score in zip(indices, values) if score > threshold]
+        lexical_ranking = [index for _, index in self.get_lexical_ranking(text, num_candidates)]
+        fused = {}
+        for ranking in [dense_ranking, lexical_ranking]:
+            for rank, index in enumerate(ranking):
+                fused[index] = fused.get(index, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:topk]
+        return self.get_results(ranked)
+
+    def search_knowledge(self, input, prefix="RAG", topk=5, input_embed=None, exact_input=None):
         # get search parameters
         threshold = self.config['SEARCH']['THRESHOLD']
         display_length = self.config['SEARCH']['DISPLAY_LENGTH']
-        # search
-        scores, metas, contents = self.get_topk(input_embed, topk=topk, threshold=threshold)
+        # terms found verbatim in exact_input (the raw user utterance) go first, at most exact_topk of them on top of topk search results
+        scores, metas, contents = [], [], []
+        if self.exact_match and exact_input is not None:
+            scores, metas, contents = self.get_exact_topk(exact_input, topk=self.exact_topk)
+        labels = ["exact" for _ in scores]
+        if len(contents) == 0 or not self.exact_match_only:
+            # get input embedding, skip the request if the caller already embedded the input
+            if input_embed is None:
+                input_embed = self.get_query_embedding(input)
+            # search, lexical only if the embedding request failed
+            if input_embed is None:
+                results, kind = self.get_lexical_topk(input, topk=topk), "bm25"
+            elif self.hybrid:
+                results, kind = self.get_hybrid_topk(input, input_embed.to(self.device), topk=topk, threshold=threshold), "rrf"
+            else:
+                results, kind = self.get_topk(input_embed.to(self.device), topk=topk, threshold=threshold), "score"
+            for score, meta, content in zip(*results):
+                if meta not in metas:
+                    scores.append(score)
+                    metas.append(meta)
+                    contents.append(content)
+                    labels.append(f"{score:.3f} {kind}")
         # generate content prompt and reference
         if len(contents) > 0:
             content_prompt = "\n".join(contents)
-            print_reference = f"{prefix} REFERENCE:\n" + "\n".join([f"[{i}] ({s:.3f} score) {m}: {c[:display_length]}" for i, (s, m, c) in enumerate(zip(scores, metas, contents))])
+            print_reference = f"{prefix} REFERENCE:\n" + "\n".join([f"[{i}] ({l}) {m}: {c[:display_length]}" for i, (l, m, c) in enumerate(zip(labels, metas, contents))])
             print(f"====="*10)
             print(print_reference)
         else:
@@ -85,4 +507,10 @@ class RAGKnowledgeBase():
             print_reference = f"{prefix} REFERENCE:\nNo related results found!"
             print(f"====="*10)
             print(print_reference)
-        return content_prompt 
\ No newline at end of file
+        return content_prompt
+
+
+
+
+
+    
@@ -6,20 +6,45 @@ from openai import OpenAI
 from chatbot_exp import ChatBot
 # from database import RAGKnowledgeBase
 from database_web import RAGKnowledgeBase
+from utils.phrase_matcher import PhraseMatcher
+from utils.phrase_suggester import PhraseSuggester
 from fewshot_exp import InContextLearner
 
 
 
-def get_input_with_format_check(event_name, event_desc, ai_role, user_role, chatbot, knowledge_phrases, config, with_suggestion=False, guide="Start your conversation, input 'break' to end conversation"):
+def get_search_key(event_name, event_desc, ai_role, user_role, user_input):
+    return f"Event: {event_name}\nDescription: {event_desc}\nai role: {ai_role}\nusers: {user_role}\nutterance: {user_input}"
+
+
+def get_input_with_format_check(event_name, event_desc, ai_role, user_role, chatbot, knowledge_phrases, config, with_suggestion=False, guide="Start your conversation, input 'break' to end conversation", phrase_matcher=None, phrase_suggester=None):
+    # return user input and the embedding of its search key (None if it was not needed here)
     print(f"====="*10)
     user_input = input(f"({guide}) Role - {user_role}: ")
     if user_input == 'break':
-        return None
+        return None, None
+    search_embed = None
+    if with_suggestion and phrase_matcher is not None:
+        # check standard phrases locally
+        phrase_check = phrase_matcher.match(user_input)
+        print(f"====="*10)
+        print(f"Phrase Check: matched {phrase_check['matched']}, partial {phrase_check['partial']}, missing {phrase_check['missing']}, non-standard {phrase_check['uncovered']}")
+    if with_suggestion and phrase_suggester is not None:
+        # near-miss phrases are corrected offline, the refine request only runs if the local suggestion is not confident
+        suggestion, confidence = phrase_suggester.suggest(user_input)
+        if suggestion != user_input and confidence >= config['REFINE_KNOWLEDGE'].get('SUGGEST_CONFIDENCE', 0.85):
+            print(f"====="*10)
+            print(f"Input Suggestion ({confidence:.2f} confidence): {suggestion}")
+            return user_input, search_embed
+    if with_suggestion and phrase_matcher is not None:
+        # inputs that already conform skip the refine request
+        if phrase_check['conforms'] and config['REFINE_KNOWLEDGE'].get('SKIP_IF_CONFORMS', False):
+            return user_input, search_embed
     if with_suggestion:
-        search_key = f"Event: {event_name}\nDescription: {event_desc}\nai role: {ai_role}\nusers: {user_role}\nutterance: {user_input}"
-        phrase_content = knowledge_phrases.search_knowledge(search_key, prefix="Phrases Knowledge", topk=config['SEARCH']['TOPK'])
+        search_key = get_search_key(event_name, event_desc, ai_role, user_role, user_input)
+        search_embed = knowledge_phrases.get_query_embedding(search_key)
+        phrase_content = knowledge_phrases.search_knowledge(search_key, prefix="Phrases Knowledge", topk=config['SEARCH']['TOPK'], input_embed=search_embed)
         refined_input = chatbot.refine_user_input_with_phrase(phrase_content, user_input)
-    return user_input
+    return user_input, search_embed
 
 def main(args):
     # load config
@@ -46,6 +71,9 @@ def main(args):
     print(f"====="*10)
     print(f"Load phrases knowledge from : {config['REFINE_KNOWLEDGE']['PHRASE_PATH']}, {config['REFINE_KNOWLEDGE']['PHRASE_NAME']}")
     knowledge_phrases = RAGKnowledgeBase(config, config['REFINE_KNOWLEDGE']['PHRASE_PATH'], database_names=config['REFINE_KNOWLEDGE']['PHRASE_NAME'])
+    phrase_matcher = PhraseMatcher.from_folder(config['REFINE_KNOWLEDGE']['PHRASE_PATH'], config['REFINE_KNOWLEDGE']['PHRASE_NAME'],
+                                               end_phrases=config['REFINE_KNOWLEDGE'].get('END_PHRASES', []))
+    phrase_suggester = PhraseSuggester(phrase_matcher, max_edit_ratio=config['REFINE_KNOWLEDGE'].get('MAX_EDIT_RATIO', 0.2))
 
 
     # load in-context learner
@@ -81,12 +109,15 @@ def main(args):
     chatbot.chat_start_phase1(event_name, event_desc, event_obj, event_point, event_conv, event_que, user_role, ai_role)
     
     while(True):
-        user_input = get_input_with_format_check(event_name, event_desc, ai_role, user_role, chatbot, knowledge_phrases, config, with_suggestion=args.with_suggestion, guide="Start your conversation, input 'break' to end conversation")
+        user_input, search_embed = get_input_with_format_check(event_name, event_desc, ai_role, user_role, chatbot, knowledge_phrases, config, with_suggestion=args.with_suggestion, guide="Start your conversation, input 'break' to end conversation", phrase_matcher=phrase_matcher, phrase_suggester=phrase_suggester)
         if user_input is None:
             return
-        search_key = f"Event: {event_name}\nDescription: {event_desc}\nai role: {ai_role}\nusers: {user_role}\nutterance: {user_input}"
-        data_content = RAG_database.search_knowledge(search_key, prefix="RAG Database", topk=config['SEARCH']['TOPK'])
-        dict_content = RAG_dictionary.search_knowledge(search_key, prefix="RAG Dictionary", topk=config['SEARCH']['TOPK'])
+        search_key = get_search_key(event_name, event_desc, ai_role, user_role, user_input)
+        # embed the search key once and reuse it for database and dictionary search
+        if search_embed is None:
+            search_embed = RAG_database.get_query_embedding(search_key)
+        data_content = RAG_database.search_knowledge(search_key, prefix="RAG Database", topk=config['SEARCH']['TOPK'], input_embed=search_embed)
+        dict_content = RAG_dictionary.search_knowledge(search_key, prefix="RAG Dictionary", topk=config['SEARCH']['TOPK'], input_embed=search_embed, exact_input=user_input)
         chatbot.chat_continue_phase1(event_name, event_desc, event_obj, event_point, event_conv, event_que, user_role, ai_role, user_input, data_content, dict_content)
     # if is_user_start:
     #     # input with format check
@@ -248,8 +248,10 @@ def process_user_message(user_input, chatbot, rag_database, rag_dictionary, know
     
     # Search knowledge
     search_key = f"Event: {event_name}\nDescription: {event_desc}\nai role: {ai_role}\nusers: {user_role}\nutterance: {user_input}"
-    data_content = rag_database.search_knowledge(search_key, prefix="RAG Database", topk=config['SEARCH']['TOPK'])
-    dict_content = rag_dictionary.search_knowledge(search_key, prefix="RAG Dictionary", topk=config['SEARCH']['TOPK'])
+    # embed the search key once and reuse it for database and dictionary search
+    search_embed = rag_database.get_query_embedding(search_key)
+    data_content = rag_database.search_knowledge(search_key, prefix="RAG Database", topk=config['SEARCH']['TOPK'], input_embed=search_embed)
+    dict_content = rag_dictionary.search_knowledge(search_key, prefix="RAG Dictionary", topk=config['SEARCH']['TOPK'], input_embed=search_embed, exact_input=user_input)
     
     # Generate response
     try:
@@ -2,11 +2,213 @@ import os
 import json
 import yaml
 import torch
+import numpy as np
+import time
 import shutil
 import argparse
+import uuid
+import multiprocessing
+import concurrent.futures
 
-from utils.pdf_loader import pdf_loader
+from utils.pdf_loader import pdf_loader, diff_pages
 from utils.embedding import get_contents_with_embedding
+from utils.embedding_cache import get_persistent_cache
+from utils.description_cache import get_description_cache
+from utils.rate_limiter import get_rate_limiter
+from utils.index_format import has_index, save_index, load_index, read_header
+from utils.bm25 import BM25Index
+from utils.ann_index import IVFIndex
+
+# versions of imported files, hidden so they are not listed as sources of the database
+VERSIONS_NAME = ".versions"
+
+
+def get_image_options(config):
+    # how page images are prepared before they are sent to the vision model
+    loader_config = config.get('PDF_LOADER', {})
+    return {'max_edge': loader_config.get('MAX_EDGE', 0),
+            'image_format': loader_config.get('IMAGE_FORMAT', "PNG"),
+            'quality': loader_config.get('IMAGE_QUALITY', 85),
+            'crop_margins': loader_config.get('CROP_MARGINS', False),
+            'auto_grayscale': loader_config.get('AUTO_GRAYSCALE', False)}
+
+
+def get_text_page_options(config):
+    # thresholds of the text page classifier, None sends every page to the vision model
+    loader_config = config.get('PDF_LOADER', {})
+    if not loader_config.get('SKIP_TEXT_PAGES', False):
+        return None
+    return {'min_chars': loader_config.get('MIN_TEXT_CHARS', 200),
+            'max_image_area': loader_config.get('MAX_IMAGE_AREA', 0.05),
+            'max_shapes': loader_config.get('MAX_SHAPES', 10)}
+
+
+def build_ivf_index(folder, config):
+    # build the ivf index of a source folder from its stored embeddings
+    if has_index(folder):
+        embedding = torch.from_numpy(load_index(folder)['embedding'])
+    else:
+        embedding = torch.load(os.path.join(folder, "contents_with_embed.pth"), weights_only=False, map_location='cpu')['embedding']
+    ivf_index = IVFIndex.build(embedding, num_lists=config.get('INDEX', {}).get('IVF_LISTS', 0))
+    ivf_index.save(folder)
+    print(f"Build ivf index with {ivf_index.centroids.shape[0]} lists for {embedding.shape[0]} items: {folder}")
+
+
+def load_previous_version(folder, model_type):
+    # raw data and {content: embedding} of an imported file, used to update it
+    # embeddings are only reused if the index records the same embedding model
+    with open(os.path.join(folder, 'raw_data.json'), "r", encoding="utf-8") as f:
+        previous_doc = json.load(f)
+    if has_index(folder) and read_header(folder).get('model') == model_type:
+        index = load_index(folder)
+        embeddings = np.asarray(index['embedding'], dtype=np.float32).tolist()
+        return previous_doc, dict(zip(index['content'], embeddings))
+    print(f"==> {folder} has no index of {model_type}, all chunks are embedded again")
+    return previous_doc, None
+
+
+def get_version_path(root_path, file_name):
+    # every version of a file is written to root/.versions/<file name>/<version>, root/<file name> links to the current one
+    versions_path = os.path.join(root_path, VERSIONS_NAME, file_name)
+    os.makedirs(versions_path, exist_ok=True)
+    # created with makedirs so the umask applies, apps running as another user can read the version
+    version_path = os.path.join(versions_path, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+    os.makedirs(version_path)
+    return version_path
+
+
+def publish_version(root_path, file_name, version_path):
+    # replace the link root/<file name> with one rename, readers open either the old or the new version
+    file_target_path = os.path.join(root_path, file_name)
+    versions_path = os.path.join(root_path, VERSIONS_NAME, file_name)
+    link_path = os.path.join(root_path, f".{file_name}.link")
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.relpath(version_path, root_path), link_path)
+    previous_path = None
+    legacy = False
+    if os.path.islink(file_target_path):
+        previous_path = os.path.realpath(file_target_path)
+    elif os.path.isdir(file_target_path):
+        # folders imported before versions existed are moved once, only this first move leaves a short gap
+        previous_path = os.path.join(versions_path, time.strftime("%Y%m%d-%H%M%S-legacy"))
+        os.rename(file_target_path, previous_path)
+        legacy = True
+    try:
+        os.replace(link_path, file_target_path)
+    except OSError:
+        if legacy:
+            os.rename(previous_path, file_target_path)
+        os.remove(link_path)
+        raise
+    # the previous version is kept for readers that are still loading it, older versions are removed
+    for name in os.listdir(versions_path):
+        path = os.path.realpath(os.path.join(versions_path, name))
+        if path not in [os.path.realpath(version_path), previous_path]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_pdf_file(root_path, file_name):
+    file_target_path = os.path.join(root_path, file_name)
+    if os.path.islink(file_target_path):
+        os.remove(file_target_path)
+        shutil.rmtree(os.path.join(root_path, VERSIONS_NAME, file_name), ignore_errors=True)
+    else:
+        shutil.rmtree(file_target_path)
+
+
+def add_pdf_file(add_file_path, config, embed_cache, embed_limiter, analyze_limiter, description_cache, executor=None, cpu_pool=None, position=None, update=False):
+    file_name = add_file_path.split('/')[-1][:-4]
+    file_source_path = add_file_path
+    root_path = config['DATABASE']['ROOT_PATH']
+    file_target_path = os.path.join(root_path, file_name)
+    if os.path.exists(file_target_path) and not update:
+        print(f"Error: File {file_name}.pdf has already been imported. Duplicate imports cannot be made! Skip this time!")
+        return
+    if os.path.exists(file_target_path):
+        print(f"Start analyze file and update it in database. File: {file_name}")
+        previous_doc, known = load_previous_version(file_target_path, config['MODEL_TYPES']['TEXT_EMBED_MODEL'])
+    else:
+        print(f"Start analyze file and add it to database. File: {file_name}")
+        previous_doc, known = None, None
+    # the new version is written to its own folder and published when it is complete
+    version_path = get_version_path(root_path, file_name)
+    try:
+        build_pdf_folder(file_name, file_source_path, version_path, config, embed_cache, embed_limiter, analyze_limiter, description_cache,
+                         executor=executor, cpu_pool=cpu_pool, position=position, previous_doc=previous_doc, known=known)
+        publish_version(root_path, file_name, version_path)
+    except BaseException:
+        # remove the incomplete version so the file can be added again, an updated file keeps its previous version
+        shutil.rmtree(version_path, ignore_errors=True)
+        raise
+    if previous_doc is not None:
+        print(f"Update file {file_name} in the database: {file_target_path}")
+
+
+def build_pdf_folder(file_name, file_source_path, file_target_path, config, embed_cache, embed_limiter, analyze_limiter, description_cache,
+                     executor=None, cpu_pool=None, position=None, previous_doc=None, known=None):
+    ######################################
+    # load and analyze pdf file
+    raw_doc = pdf_loader(file_name, file_source_path, model_type=config['MODEL_TYPES']['PDF_ANALYZE_MODEL'], rate_limiter=analyze_limiter,
+                         workers=config.get('PDF_LOADER', {}).get('WORKERS', 1),
+                         max_retries=config.get('PDF_LOADER', {}).get('MAX_RETRIES', 2),
+                         dpi=config.get('PDF_LOADER', {}).get('DPI', 200),
+                         grayscale=config.get('PDF_LOADER', {}).get('GRAYSCALE', False),
+                         window=config.get('PDF_LOADER', {}).get('WINDOW', 8),
+                         image_options=get_image_options(config),
+                         text_page_options=get_text_page_options(config),
+                         executor=executor, cpu_pool=cpu_pool, position=position, description_cache=description_cache,
+                         previous_doc=previous_doc)
+    if previous_doc is not None:
+        if 'page_fingerprints' in previous_doc:
+            counts = diff_pages(previous_doc['page_fingerprints'], raw_doc['page_fingerprints'])
+            print(f"==> {file_name}: {counts['added']} pages added, {counts['removed']} removed, {counts['changed']} changed, {counts['unchanged']} unchanged")
+        else:
+            print(f"==> {file_name} was imported without page fingerprints, all pages are analyzed again")
+    # save raw data
+    with open(os.path.join(file_target_path, 'raw_data.json'), "w", encoding="utf-8") as f:
+        json.dump(raw_doc, f, ensure_ascii=False, indent=4)
+    # get contents with embeddings
+    contents_with_embed = get_contents_with_embedding(raw_doc, overlap=config['DATABASE']['OVERLAP_LENGTH'], 
+                                                               text_length=config['DATABASE']['TEXT_LENGTH'], 
+                                                               model_type=config['MODEL_TYPES']['TEXT_EMBED_MODEL'],
+                                                               cache=embed_cache, rate_limiter=embed_limiter,
+                                                               batch_size=config.get('EMBEDDING', {}).get('BATCH_SIZE', 256),
+                                                               batch_tokens=config.get('EMBEDDING', {}).get('BATCH_TOKENS', 100000),
+                                                               snap=config['DATABASE'].get('SNAP_BOUNDARIES', False),
+                                                               known=known)
+    # save contents with embeddings as memory-mapped index
+    save_index(contents_with_embed, file_target_path, dtype=config.get('INDEX', {}).get('DTYPE', 'float16'), model_type=config['MODEL_TYPES']['TEXT_EMBED_MODEL'])
+    BM25Index.build(contents_with_embed['content']).save(file_target_path)
+    if config.get('INDEX', {}).get('BUILD_IVF', True):
+        build_ivf_index(file_target_path, config)
+    # for human review only
+    contents_with_embed.pop('embedding')
+    with open(os.path.join(file_target_path, 'contents_without_embed.json'), "w", encoding="utf-8") as f:
+        json.dump(contents_with_embed, f, ensure_ascii=False, indent=4)
+
+
+def add_pdf_files(all_files, config, embed_cache, embed_limiter, analyze_limiter, description_cache, workers, update=False):
+    # files are loaded concurrently: layout extraction and rasterization run in a process pool,
+    # page analysis of all files shares one thread pool and the rate limiters of the process
+    io_workers = config.get('PDF_LOADER', {}).get('WORKERS', 1)
+    cpu_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    with cpu_pool, concurrent.futures.ThreadPoolExecutor(max_workers=io_workers) as io_pool, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as file_pool:
+        futures = {file_pool.submit(add_pdf_file, add_file_path, config, embed_cache, embed_limiter, analyze_limiter, description_cache,
+                                    executor=io_pool, cpu_pool=cpu_pool, position=i % workers, update=update): add_file_path for i, add_file_path in enumerate(all_files)}
+        # a failed file does not stop the others
+        failed = []
+        for done, future in enumerate(concurrent.futures.as_completed(futures)):
+            add_file_path = futures[future]
+            try:
+                future.result()
+                print(f"==> Finish file ({done + 1}/{len(futures)}): {add_file_path}")
+            except Exception as e:
+                failed.append(add_file_path)
+                print(f"==> Failed file ({done + 1}/{len(futures)}): {add_file_path}: {e}")
+    if len(failed) > 0:
+        print(f"==> {len(failed)} files failed: {failed}")
+
 
 def main(args):
     # load config
@@ -17,13 +219,40 @@ def main(args):
     if "OPENAI_API_KEY" not in os.environ:
         os.environ["OPENAI_API_KEY"] = config['API_KEY']
 
+    # persistent embedding and page description caches, re-ingested chunks and pages reuse earlier results
+    embed_cache = get_persistent_cache(config)
+    description_cache = get_description_cache(config)
+    embed_limiter = get_rate_limiter(config, 'TEXT_EMBED_MODEL')
+    analyze_limiter = get_rate_limiter(config, 'PDF_ANALYZE_MODEL')
+
+    # convert pickled contents_with_embed.pth into the memory-mapped index format
+    if args.convert_index:
+        root_path = config['DATABASE']['ROOT_PATH']
+        for name in sorted(os.listdir(root_path)):
+            folder = os.path.join(root_path, name)
+            pth_path = os.path.join(folder, "contents_with_embed.pth")
+            if not os.path.exists(pth_path) or has_index(folder):
+                continue
+            contents_with_embed = torch.load(pth_path, weights_only=False, map_location='cpu')
+            save_index(contents_with_embed, folder, dtype=config.get('INDEX', {}).get('DTYPE', 'float16'), model_type=config['MODEL_TYPES']['TEXT_EMBED_MODEL'])
+            BM25Index.build(contents_with_embed['content']).save(folder)
+            print(f"Convert {name} to memory-mapped index: {folder}")
+
+    # build ivf index for all existing files
+    if args.build_ann:
+        root_path = config['DATABASE']['ROOT_PATH']
+        for name in sorted(os.listdir(root_path)):
+            folder = os.path.join(root_path, name)
+            if has_index(folder) or os.path.exists(os.path.join(folder, "contents_with_embed.pth")):
+                build_ivf_index(folder, config)
+
     # remove file
     if args.remove_file is not None:
         assert args.remove_file.endswith(".pdf"), f"Invalid PDF File: {args.remove_file}"
         file_name = args.remove_file.split('/')[-1][:-4]
         file_target_path = os.path.join(config['DATABASE']['ROOT_PATH'], file_name)
-        if os.path.exists(file_target_path):
-            shutil.rmtree(file_target_path)
+        if os.path.lexists(file_target_path):
+            remove_pdf_file(config['DATABASE']['ROOT_PATH'], file_name)
             print(f"Delete file {file_name} from the database: Remove folder {file_target_path}")
         else:
             print(f"File does not exist in the database: {file_name}")
@@ -36,31 +265,21 @@ def main(args):
         else:
             all_files = [os.path.join(args.add_file, file) for file in os.listdir(args.add_file) if file.endswith(".pdf")]
         # load all files
-        for add_file_path in all_files:
-            file_name = add_file_path.split('/')[-1][:-4]
-            file_source_path = add_file_path
-            file_target_path = os.path.join(config['DATABASE']['ROOT_PATH'], file_name)
-            if os.path.exists(file_target_path):
-                print(f"Error: File {file_name}.pdf has already been imported. Duplicate imports cannot be made! Skip this time!")
-            else:
-                print(f"Start analyze file and add it to database. File: {file_name}")
-                os.makedirs(file_target_path, exist_ok=False)
-                ######################################
-                # load and analyze pdf file
-                raw_doc = pdf_loader(file_name, file_source_path, model_type=config['MODEL_TYPES']['PDF_ANALYZE_MODEL'])
-                # save raw data
-                with open(os.path.join(file_target_path, 'raw_data.json'), "w", encoding="utf-8") as f:
-                    json.dump(raw_doc, f, ensure_ascii=False, indent=4)
-                # get contents with embeddings
-                contents_with_embed = get_contents_with_embedding(raw_doc, overlap=config['DATABASE']['OVERLAP_LENGTH'], 
-                                                                           text_length=config['DATABASE']['TEXT_LENGTH'], 
-                                                                           model_type=config['MODEL_TYPES']['TEXT_EMBED_MODEL'])
-                # save contents with embeddings
-                torch.save(contents_with_embed, os.path.join(file_target_path, "contents_with_embed.pth"))
-                # for human review only
-                contents_with_embed.pop('embedding')
-                with open(os.path.join(file_target_path, 'contents_without_embed.json'), "w", encoding="utf-8") as f:
-                    json.dump(contents_with_embed, f, ensure_ascii=False, indent=4)
+        if args.workers <= 1:
+            # a failed file does not stop the others
+            failed = []
+            for add_file_path in all_files:
+                try:
+                    add_pdf_file(add_file_path, config, embed_cache, embed_limiter, analyze_limiter, description_cache, update=args.update)
+                except Exception as e:
+                    failed.append(add_file_path)
+                    print(f"==> Failed file: {add_file_path}: {e}")
+            if len(failed) > 0:
+                print(f"==> {len(failed)} files failed: {failed}")
+        else:
+            add_pdf_files(all_files, config, embed_cache, embed_limiter, analyze_limiter, description_cache, args.workers, update=args.update)
+        if description_cache is not None and description_cache.stats()['hits'] > 0:
+            print(f"==> Reuse {description_cache.stats()['hits']} page descriptions from cache")
 
 
 if __name__ == "__main__":
@@ -68,5 +287,9 @@ if __name__ == "__main__":
     parser.add_argument('--config_path', type=str, default='./configs/config.yaml', help='config path')
     parser.add_argument('--add_file', type=str, default=None, help='add pdf file path or a folder that contains pdf files')
     parser.add_argument('--remove_file', type=str, default=None, help='add pdf file path')
+    parser.add_argument('--convert_index', action='store_true', default=False, help='convert existing contents_with_embed.pth files to the memory-mapped index format')
+    parser.add_argument('--build_ann', action='store_true', default=False, help='build ivf index for all files in the database')
+    parser.add_argument('--workers', type=int, default=1, help='number of pdf files added in parallel')
+    parser.add_argument('--update', action='store_true', default=False, help='with --add_file, update files that were already imported, only changed pages are analyzed and embedded again')
     args = parser.parse_args()
     main(args)
\ No newline at end of file
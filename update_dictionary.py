@@ -6,6 +6,27 @@ import shutil
 import argparse
 
 from utils.embedding import get_dictionary_with_embedding
+from utils.embedding_cache import get_persistent_cache
+from utils.rate_limiter import get_rate_limiter
+from utils.index_format import has_index, save_index, load_index
+from utils.bm25 import BM25Index
+from utils.hnsw_index import HNSWIndex
+
+
+def build_hnsw_index(folder, config):
+    # insert all entries of a dictionary into a new hnsw graph saved beside its index files
+    if has_index(folder):
+        embedding = load_index(folder)['embedding']
+    else:
+        embedding = torch.load(os.path.join(folder, "contents_with_embed.pth"), weights_only=False, map_location='cpu')['embedding']
+        embedding = torch.nn.functional.normalize(embedding.float(), dim=-1).numpy()
+    hnsw_index = HNSWIndex(M=config.get('INDEX', {}).get('HNSW_M', 16),
+                           ef_construction=config.get('INDEX', {}).get('HNSW_EF_CONSTRUCTION', 100))
+    hnsw_index.attach(embedding)
+    hnsw_index.add_items(range(embedding.shape[0]))
+    hnsw_index.save(folder)
+    print(f"Build hnsw index for {embedding.shape[0]} items: {folder}")
+
 
 def main(args):
     # load config
@@ -16,6 +37,31 @@ def main(args):
     if "OPENAI_API_KEY" not in os.environ:
         os.environ["OPENAI_API_KEY"] = config['API_KEY']
 
+    # persistent embedding cache, re-ingested chunks reuse vectors already computed
+    embed_cache = get_persistent_cache(config)
+    embed_limiter = get_rate_limiter(config, 'TEXT_EMBED_MODEL')
+
+    # convert pickled contents_with_embed.pth into the memory-mapped index format
+    if args.convert_index:
+        root_path = config['DICTIONARY']['ROOT_PATH']
+        for name in sorted(os.listdir(root_path)):
+            folder = os.path.join(root_path, name)
+            pth_path = os.path.join(folder, "contents_with_embed.pth")
+            if not os.path.exists(pth_path) or has_index(folder):
+                continue
+            contents_with_embed = torch.load(pth_path, weights_only=False, map_location='cpu')
+            save_index(contents_with_embed, folder, dtype=config.get('INDEX', {}).get('DTYPE', 'float16'), model_type=config['MODEL_TYPES']['TEXT_EMBED_MODEL'])
+            BM25Index.build(contents_with_embed['content']).save(folder)
+            print(f"Convert {name} to memory-mapped index: {folder}")
+
+    # build hnsw index for all existing files
+    if args.build_ann:
+        root_path = config['DICTIONARY']['ROOT_PATH']
+        for name in sorted(os.listdir(root_path)):
+            folder = os.path.join(root_path, name)
+            if has_index(folder) or os.path.exists(os.path.join(folder, "contents_with_embed.pth")):
+                build_hnsw_index(folder, config)
+
     # remove file
     if args.remove_file is not None:
         assert args.remove_file.endswith(".json"), f"Invalid Json File: {args.remove_file}"
@@ -51,10 +97,16 @@ def main(args):
                 with open(os.path.join(file_target_path, 'raw_dict.json'), "w", encoding="utf-8") as f:
                     json.dump(raw_dict, f, ensure_ascii=False, indent=4)
                 # get contents with embeddings
-                contents_with_embed = get_dictionary_with_embedding(raw_dict, file_name, model_type=config['MODEL_TYPES']['TEXT_EMBED_MODEL'])
+                contents_with_embed = get_dictionary_with_embedding(raw_dict, file_name, model_type=config['MODEL_TYPES']['TEXT_EMBED_MODEL'], cache=embed_cache, rate_limiter=embed_limiter,
+                                                                    batch_size=config.get('EMBEDDING', {}).get('BATCH_SIZE', 256),
+                                                                    batch_tokens=config.get('EMBEDDING', {}).get('BATCH_TOKENS', 100000))
 
-                # save contents with embeddings
-                torch.save(contents_with_embed, os.path.join(file_target_path, "contents_with_embed.pth"))
+                # save contents with embeddings as memory-mapped index
+                save_index(contents_with_embed, file_target_path, dtype=config.get('INDEX', {}).get('DTYPE', 'float16'), model_type=config['MODEL_TYPES']['TEXT_EMBED_MODEL'])
+                BM25Index.build(contents_with_embed['content']).save(file_target_path)
+                # only the new dictionary is indexed, graphs of the other dictionaries stay untouched
+                if config.get('INDEX', {}).get('BUILD_HNSW', True):
+                    build_hnsw_index(file_target_path, config)
 
 
 if __name__ == "__main__":
@@ -62,5 +114,7 @@ if __name__ == "__main__":
     parser.add_argument('--config_path', type=str, default='./configs/config.yaml', help='config path')
     parser.add_argument('--add_file', type=str, default=None, help='add json dictionary path or a folder that contains json dictionary files')
     parser.add_argument('--remove_file', type=str, default=None, help='add json dictionary file path')
+    parser.add_argument('--convert_index', action='store_true', default=False, help='convert existing contents_with_embed.pth files to the memory-mapped index format')
+    parser.add_argument('--build_ann', action='store_true', default=False, help='build hnsw index for all files in the dictionary')
     args = parser.parse_args()
     main(args)
\ No newline at end of file
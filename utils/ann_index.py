@@ -0,0 +1,77 @@
+import os
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+IVF_INDEX_NAME = "ivf_index.npz"
+
+
+class IVFIndex():
+    # inverted file index: spherical k-means coarse quantizer + one list of row ids per centroid
+    def __init__(self, centroids, list_offsets, list_ids, count, nprobe=8):
+        self.nprobe = nprobe                # number of lists searched per query
+        self.centroids = centroids          # (num_lists, dim) float32, normalized
+        self.list_offsets = list_offsets    # (num_lists + 1,) int64, ids of list i are list_ids[offsets[i]:offsets[i+1]]
+        self.list_ids = list_ids            # (count,) int64 row ids grouped by list
+        self.count = count
+
+    @classmethod
+    def build(cls, embeddings, num_lists=0, iterations=20, seed=0, chunk_size=8192):
+        embeddings = F.normalize(torch.as_tensor(embeddings).float(), dim=-1)
+        count = embeddings.shape[0]
+        if num_lists <= 0:
+            num_lists = int(round(math.sqrt(count)))
+        num_lists = max(1, min(num_lists, count))
+
+        generator = torch.Generator().manual_seed(seed)
+        centroids = embeddings[torch.randperm(count, generator=generator)[:num_lists]].clone()
+        for _ in range(iterations):
+            assign = cls.assign(embeddings, centroids, chunk_size)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, embeddings)
+            counts = torch.bincount(assign, minlength=num_lists)
+            # re-seed empty lists with random rows
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = embeddings[torch.randint(count, (int(empty.sum()),), generator=generator)]
+            centroids = F.normalize(sums, dim=-1)
+
+        assign = cls.assign(embeddings, centroids, chunk_size)
+        list_ids = torch.argsort(assign, stable=True)
+        list_offsets = torch.zeros(num_lists + 1, dtype=torch.int64)
+        list_offsets[1:] = torch.cumsum(torch.bincount(assign, minlength=num_lists), dim=0)
+        return cls(centroids, list_offsets, list_ids, count)
+
+    @staticmethod
+    def assign(embeddings, centroids, chunk_size=8192):
+        # nearest centroid of every row, computed in chunks to bound memory
+        assign = []
+        for start in range(0, embeddings.shape[0], chunk_size):
+            assign.append(torch.mm(embeddings[start:start + chunk_size], centroids.t()).argmax(dim=1))
+        return torch.cat(assign, dim=0)
+
+    def search(self, query, k=None):
+        # row ids of the nprobe lists whose centroids are closest to the normalized query, k is unused
+        query = query.to(self.centroids.device, self.centroids.dtype)
+        nprobe = min(self.nprobe, self.centroids.shape[0])
+        lists = torch.topk(torch.mv(self.centroids, query), k=nprobe, largest=True).indices.tolist()
+        ids = [self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists]
+        return torch.cat(ids, dim=0)
+
+    def save(self, folder):
+        tmp_path = os.path.join(folder, IVF_INDEX_NAME + ".tmp.npz")
+        np.savez(tmp_path, centroids=self.centroids.cpu().numpy(),
+                 list_offsets=self.list_offsets.cpu().numpy(),
+                 list_ids=self.list_ids.cpu().numpy(),
+                 count=np.array(self.count, dtype=np.int64))
+        os.replace(tmp_path, os.path.join(folder, IVF_INDEX_NAME))
+
+    @classmethod
+    def load(cls, folder, nprobe=8):
+        # return None if the folder has no ivf index
+        path = os.path.join(folder, IVF_INDEX_NAME)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            return cls(torch.from_numpy(data['centroids']), torch.from_numpy(data['list_offsets']),
+                       torch.from_numpy(data['list_ids']), int(data['count']), nprobe=nprobe)
@@ -0,0 +1,80 @@
+import os
+import re
+import json
+import math
+import numpy as np
+
+BM25_INDEX_NAME = "bm25_index.json"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.'][a-z0-9]+)*")
+
+
+def tokenize(text):
+    # lowercase words, keeps dotted acronyms like "a.c" and numbers as one token
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class BM25Index():
+    # inverted index with okapi bm25 scoring, needs no network
+    def __init__(self, postings, doc_len, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = postings            # term -> (doc ids, term frequencies) numpy arrays
+        self.doc_len = doc_len              # number of tokens per document
+        self.count = doc_len.shape[0]
+        self.avgdl = float(doc_len.mean()) if self.count > 0 else 0.0
+
+    @classmethod
+    def build(cls, texts, k1=1.5, b=0.75):
+        postings = {}
+        doc_len = []
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len.append(len(tokens))
+            term_freq = {}
+            for token in tokens:
+                term_freq[token] = term_freq.get(token, 0) + 1
+            for term, freq in term_freq.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(doc_id)
+                postings[term][1].append(freq)
+        postings = {term: (np.array(ids, dtype=np.int64), np.array(freqs, dtype=np.float32)) for term, (ids, freqs) in postings.items()}
+        return cls(postings, np.array(doc_len, dtype=np.float32), k1=k1, b=b)
+
+    def search(self, query, k=10):
+        # (scores, doc ids) of the best k documents with a positive score, best first
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            ids, freqs = self.postings[term]
+            idf = math.log(1.0 + (self.count - ids.shape[0] + 0.5) / (ids.shape[0] + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[ids] / max(self.avgdl, 1e-8))
+            scores[ids] += idf * freqs * (self.k1 + 1.0) / (freqs + norm)
+        k = min(k, self.count)
+        if k <= 0:
+            return [], []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[scores[top] > 0]
+        return scores[top].tolist(), top.tolist()
+
+    def save(self, folder):
+        data = {'k1': self.k1,
+                'b': self.b,
+                'doc_len': self.doc_len.astype(int).tolist(),
+                'postings': {term: [ids.tolist(), freqs.astype(int).tolist()] for term, (ids, freqs) in self.postings.items()}}
+        tmp_path = os.path.join(folder, BM25_INDEX_NAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(folder, BM25_INDEX_NAME))
+
+    @classmethod
+    def load(cls, folder):
+        # return None if the folder has no bm25 index
+        path = os.path.join(folder, BM25_INDEX_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+        postings = {term: (np.array(ids, dtype=np.int64), np.array(freqs, dtype=np.float32)) for term, (ids, freqs) in data['postings'].items()}
+        return cls(postings, np.array(data['doc_len'], dtype=np.float32), k1=data['k1'], b=data['b'])
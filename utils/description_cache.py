@@ -0,0 +1,57 @@
+import os
+import sqlite3
+import hashlib
+import threading
+
+
+class PageDescriptionCache():
+    # on-disk cache of vision model page descriptions, keyed by hash of (model, prompt, encoded page image)
+    # a re-ingested page that renders to the same image is not sent to the vision model again
+    def __init__(self, db_path):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS descriptions (key TEXT PRIMARY KEY, model TEXT, description TEXT)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(model, prompt, data_uri):
+        # the data uri is what the model sees, so changed image options (size, format, quality) miss the cache
+        return hashlib.sha256(f"{model}\n{prompt}\n{data_uri}".encode('utf-8')).hexdigest()
+
+    def get(self, model, prompt, data_uri):
+        key = self.get_key(model, prompt, data_uri)
+        with self.lock:
+            row = self.conn.execute("SELECT description FROM descriptions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, model, prompt, data_uri, description):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO descriptions (key, model, description) VALUES (?, ?, ?)",
+                              (self.get_key(model, prompt, data_uri), model, description))
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def get_description_cache(config):
+    # return None when no cache file is configured
+    db_path = config.get('PDF_LOADER', {}).get('DESCRIPTION_CACHE')
+    if not db_path:
+        return None
+    return PageDescriptionCache(db_path)
@@ -14,89 +14,180 @@ import numpy as np
 from rich import print
 import time
 
+from utils.rate_limiter import estimate_tokens
 
-def clean_contents(raw_doc, overlap=10, text_length=100):
+
+WORD_PATTERN = re.compile(r"\S+")
+SENTENCE_END_PATTERN = re.compile(r"[.!?:;]['\")\]]*$")
+
+
+def get_windows(boundary, text_length=100, overlap=10, snap=True):
+    # (start, end) word index windows of text_length words overlapping by overlap words, linear in the number of words
+    # with snap, a window ends at the last boundary word in its second half if there is one
+    assert text_length > overlap
+    windows = []
+    start = 0
+    while start < len(boundary):
+        end = min(start + text_length, len(boundary))
+        if snap and end < len(boundary):
+            for i in range(end - 1, start + text_length // 2 - 1, -1):
+                if boundary[i]:
+                    end = i + 1
+                    break
+        windows.append((start, end))
+        if end == len(boundary):
+            break
+        start = max(end - overlap, start + 1)
+    return windows
+
+
+def chunk_words(text, text_length=100, overlap=10, snap=True):
+    # (start, end) character offsets of windows of text_length words overlapping by overlap words
+    # with snap, a window ends at the last sentence or line end in its second half if there is one
+    spans = [match.span() for match in WORD_PATTERN.finditer(text)]
+    boundary = [SENTENCE_END_PATTERN.search(text[begin:end]) is not None or text[end:end + 1] in ["\n", "\f"] for begin, end in spans]
+    return [(spans[start][0], spans[end - 1][1]) for start, end in get_windows(boundary, text_length=text_length, overlap=overlap, snap=snap)]
+
+
+def clean_str(content):
+    content = content.replace('\f', '')
+    content = content.replace(' \n', '').replace('\n\n', '\n').replace('\n\n\n', '\n').strip()
+    content = re.sub(r"(?<=\n)\d{1,2}", "", content)
+    content = re.sub(r"\b(?:the|this)\s*slide\s*\w+\b", "", content, flags=re.IGNORECASE)
+    return content
+
+
+def clean_str_with_positions(content):
+    # clean_str that also returns the position in content of every kept character, every step only deletes characters
+    positions = list(range(len(content)))
+    steps = [(re.compile('\f'), 0), (re.compile(' \n'), 0), (re.compile('\n\n'), 1), (re.compile('\n\n\n'), 1), (re.compile(r"^\s+|\s+$"), 0),
+             (re.compile(r"(?<=\n)\d{1,2}"), 0), (re.compile(r"\b(?:the|this)\s*slide\s*\w+\b", flags=re.IGNORECASE), 0)]
+    for pattern, keep in steps:
+        # keep the first keep characters of every match, like str.replace('\n\n', '\n')
+        kept_text, kept_positions, last = [], [], 0
+        for match in pattern.finditer(content):
+            kept_text.append(content[last:match.start() + keep])
+            kept_positions.extend(positions[last:match.start() + keep])
+            last = match.end()
+        kept_text.append(content[last:])
+        kept_positions.extend(positions[last:])
+        content, positions = "".join(kept_text), kept_positions
+    return content, positions
+
+
+def clean_contents(raw_doc, overlap=10, text_length=100, snap=True):
     filename = raw_doc['filename']
     text = raw_doc['text']
     description = raw_doc['pages_description']
-
-    def clean_str(content):
-        content = content.replace('\f', '')
-        content = content.replace(' \n', '').replace('\n\n', '\n').replace('\n\n\n', '\n').strip()
-        content = re.sub(r"(?<=\n)\d{1,2}", "", content)
-        content = re.sub(r"\b(?:the|this)\s*slide\s*\w+\b", "", content, flags=re.IGNORECASE)
-        return content
     
-    clean_text = clean_str(text)
     clean_description = [clean_str(desc) for desc in description]
 
     clean_contents = []
     # add description
     for i, content in enumerate(clean_description):
+        # pages that failed analysis have no description
+        if len(content) == 0:
+            continue
         clean_contents.append({'meta': f"File: <<{filename}>> Desc Page-{i}",
-                               "content": content})
+                               "content": content,
+                               "offset": None})
     
-    # add raw text with length 1000 and overlap 100
-    text_list = clean_text.split(" ")
-    text_id = 0
-    assert text_length > overlap
-    while(len(text_list) > text_length):
+    # add raw text in windows of text_length words, offset is the character range of the chunk in raw_doc['text']
+    if snap:
+        # words are cut from the raw text so windows can end at line ends, each chunk is cleaned on its own
+        chunks = [(clean_str(text[start:end]), start, end) for start, end in chunk_words(text, text_length=text_length, overlap=overlap, snap=True)]
+    else:
+        # same chunks as before offsets were kept: the whole text is cleaned and split on spaces
+        clean_text, positions = clean_str_with_positions(text)
+        starts = [0]
+        for word in clean_text.split(" "):
+            starts.append(starts[-1] + len(word) + 1)
+        chunks = []
+        for start, end in get_windows([False] * (len(starts) - 1), text_length=text_length, overlap=overlap, snap=False):
+            begin, finish = starts[start], starts[end] - 1
+            chunks.append((clean_text[begin:finish], positions[begin] if begin < finish else 0, positions[finish - 1] + 1 if begin < finish else 0))
+    for text_id, (content, start, end) in enumerate(chunks):
+        if len(content) == 0:
+            continue
         clean_contents.append({'meta': f"File: <<{filename}>> Text Index-{text_id}",
-                               "content": " ".join(text_list[:text_length])})
-        text_list = text_list[text_length-overlap:]
-        text_id += 1
-    clean_contents.append({'meta': f"File: <<{filename}>> Text Index-{text_id}",
-                               "content": " ".join(text_list)})
+                               "content": content,
+                               "offset": [start, end]})
     return clean_contents
 
 
 
-def get_contents_with_embedding(raw_doc, overlap=10, text_length=100, model_type="text-embedding-3-large"):
-    contents = clean_contents(raw_doc, overlap=overlap, text_length=text_length)
+def get_batches(indices, texts, batch_size=256, batch_tokens=100000):
+    # pack texts into requests of at most batch_size inputs and batch_tokens estimated tokens
+    batches = []
+    batch = []
+    tokens = 0
+    for i in indices:
+        if len(batch) > 0 and (len(batch) >= batch_size or tokens + estimate_tokens(texts[i]) > batch_tokens):
+            batches.append(batch)
+            batch = []
+            tokens = 0
+        batch.append(i)
+        tokens += estimate_tokens(texts[i])
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def embed_texts(texts, model_type="text-embedding-3-large", cache=None, rate_limiter=None, batch_size=256, batch_tokens=100000, known=None):
+    # embed texts with multi-input requests, texts already in the persistent cache are not requested again
+    # known maps texts to embeddings computed before, e.g. chunks of the previous version of a file
+    cached = cache.get_many(model_type, texts) if cache is not None else [None] * len(texts)
+    if known is not None:
+        cached = [known.get(text) if embedding is None else embedding for text, embedding in zip(texts, cached)]
+    missing = [i for i, embedding in enumerate(cached) if embedding is None]
+    if len(missing) < len(texts):
+        print(f"Reuse {len(texts) - len(missing)}/{len(texts)} embeddings from cache")
 
     client = OpenAI()
-    def get_embeddings(text):
+    def get_embeddings(batch_texts):
         embeddings = client.embeddings.create(
         model=model_type,
-        input=text,
+        input=batch_texts,
         encoding_format="float"
         )
-        return embeddings.data[0].embedding
-    
-    embeddings = []
-    with tqdm(total=len(contents)-1) as pbar:
-        for item in contents:
-            # set sleep to avoid trigger tokens per minute (TPM) limit
-            time.sleep(1) 
-            embeddings.append(get_embeddings(item['content']))
-            pbar.update(1)
+        # results carry the position of their input, keep the input order
+        return [item.embedding for item in sorted(embeddings.data, key=lambda item: item.index)]
+
+    embeddings = list(cached)
+    with tqdm(total=len(missing)) as pbar:
+        for batch in get_batches(missing, texts, batch_size=batch_size, batch_tokens=batch_tokens):
+            batch_texts = [texts[i] for i in batch]
+            if rate_limiter is not None:
+                # wait for the requests per minute (RPM) and tokens per minute (TPM) budget
+                batch_embeddings = rate_limiter.call(get_embeddings, batch_texts, tokens=sum(estimate_tokens(text) for text in batch_texts))
+            else:
+                batch_embeddings = get_embeddings(batch_texts)
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+            if cache is not None:
+                cache.put_many(model_type, batch_texts, batch_embeddings)
+            pbar.update(len(batch))
+    return embeddings
+
+
+def get_contents_with_embedding(raw_doc, overlap=10, text_length=100, model_type="text-embedding-3-large", cache=None, rate_limiter=None, batch_size=256, batch_tokens=100000, snap=True, known=None):
+    contents = clean_contents(raw_doc, overlap=overlap, text_length=text_length, snap=snap)
+
+    embeddings = embed_texts([item['content'] for item in contents], model_type=model_type, cache=cache, rate_limiter=rate_limiter, batch_size=batch_size, batch_tokens=batch_tokens, known=known)
     embeddings = torch.FloatTensor(embeddings)
 
     contents_with_embed = {'meta': [item['meta'] for item in contents],
                            'content': [item['content'] for item in contents],
+                           'offset': [item['offset'] for item in contents],
                            'embedding': embeddings}
     
     return contents_with_embed
 
 
-def get_dictionary_with_embedding(raw_dict, dict_name, model_type="text-embedding-3-large"):
+def get_dictionary_with_embedding(raw_dict, dict_name, model_type="text-embedding-3-large", cache=None, rate_limiter=None, batch_size=256, batch_tokens=100000):
     contents = [{'meta': f"File: <<{dict_name}>> Dict Index-{index}", "content": {str(item)}} for index, item in enumerate(raw_dict)]
 
-    client = OpenAI()
-    def get_embeddings(text):
-        embeddings = client.embeddings.create(
-        model=model_type,
-        input=text,
-        encoding_format="float"
-        )
-        return embeddings.data[0].embedding
-    
-    embeddings = []
-    with tqdm(total=len(contents)-1) as pbar:
-        for item in contents:
-            # set sleep to avoid trigger tokens per minute (TPM) limit
-            embeddings.append(get_embeddings(item['content']))
-            pbar.update(1)
+    embeddings = embed_texts([str(item) for item in raw_dict], model_type=model_type, cache=cache, rate_limiter=rate_limiter, batch_size=batch_size, batch_tokens=batch_tokens)
     embeddings = torch.FloatTensor(embeddings)
 
     contents_with_embed = {'meta': [item['meta'] for item in contents],
@@ -104,8 +195,3 @@ def get_dictionary_with_embedding(raw_dict, dict_name, model_type="text-embeddin
                            'embedding': embeddings}
     
     return contents_with_embed
-
-    
-     
-
-
@@ -0,0 +1,115 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class EmbeddingLRUCache():
+    # in-process cache of query embeddings keyed by (model, text)
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl              # seconds, None or 0 means entries never expire
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model, text):
+        key = (model, text)
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            embedding, created = item
+            if self.ttl and time.monotonic() - created > self.ttl:
+                self.entries.pop(key)
+                self.misses += 1
+                return None
+            # mark as most recently used
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, model, text, embedding):
+        if self.max_entries <= 0:
+            return
+        key = (model, text)
+        with self.lock:
+            self.entries[key] = (embedding, time.monotonic())
+            self.entries.move_to_end(key)
+            # evict least recently used entries
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / total if total > 0 else 0.0}
+
+
+class PersistentEmbeddingCache():
+    # on-disk embedding cache shared by all processes, keyed by hash of (model, text), vectors stored as float16
+    def __init__(self, db_path):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        # WAL lets several streamlit workers read while one process writes
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, dim INTEGER, vector BLOB)")
+        self.conn.commit()
+
+    @staticmethod
+    def get_key(model, text):
+        return hashlib.sha256(f"{model}\n{text}".encode('utf-8')).hexdigest()
+
+    def get(self, model, text):
+        return self.get_many(model, [text])[0]
+
+    def get_many(self, model, texts):
+        keys = [self.get_key(model, text) for text in texts]
+        found = {}
+        with self.lock:
+            # sqlite limits the number of query parameters, so look up in slices
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float16).astype(np.float32).tolist()
+        return [found.get(key) for key in keys]
+
+    def put(self, model, text, embedding):
+        self.put_many(model, [text], [embedding])
+
+    def put_many(self, model, texts, embeddings):
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float16)
+            rows.append((self.get_key(model, text), model, vector.shape[0], vector.tobytes()))
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings (key, model, dim, vector) VALUES (?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def get_persistent_cache(config):
+    # return None when no cache file is configured
+    db_path = config.get('EMBED_CACHE', {}).get('DB_PATH')
+    if not db_path:
+        return None
+    return PersistentEmbeddingCache(db_path)
@@ -0,0 +1,178 @@
+import os
+import math
+import heapq
+import threading
+import numpy as np
+import torch
+
+HNSW_INDEX_NAME = "hnsw_index.npz"
+
+
+class HNSWIndex():
+    # hierarchical navigable small world graph over normalized vectors, similarity is the dot product
+    # node ids are row ids of the attached vectors, nodes are inserted one by one so a graph can grow without a rebuild
+    def __init__(self, M=16, ef_construction=100, ef=64, seed=0):
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.level_mult = 1.0 / math.log(max(M, 2))
+        self.rng = np.random.default_rng(seed)
+        self.vectors = None
+        self.levels = {}        # node id -> top level of the node
+        self.neighbors = {}     # node id -> one neighbor list per level
+        self.entry_point = None
+        self.max_level = -1
+        self.path = None        # graph file, loaded on first use
+        self.load_lock = threading.Lock()
+        self.count = 0
+
+    def attach(self, vectors):
+        # vectors is a (n, dim) array, e.g. the memory-mapped embedding of the source
+        self.vectors = vectors
+
+    def max_links(self, level):
+        return 2 * self.M if level == 0 else self.M
+
+    def similarity(self, query, ids):
+        return np.asarray(self.vectors[ids], dtype=np.float32) @ query
+
+    def search_layer(self, query, entry_points, ef, level):
+        # best-first search on one level, returns up to ef (similarity, id) pairs, best first
+        visited = set(entry_points)
+        sims = self.similarity(query, entry_points)
+        candidates = [(-float(sim), node) for sim, node in zip(sims, entry_points)]
+        results = [(float(sim), node) for sim, node in zip(sims, entry_points)]
+        heapq.heapify(candidates)
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        while len(candidates) > 0:
+            neg_sim, node = heapq.heappop(candidates)
+            if -neg_sim < results[0][0] and len(results) >= ef:
+                break
+            neighbors = [neighbor for neighbor in self.neighbors[node][level] if neighbor not in visited]
+            if len(neighbors) == 0:
+                continue
+            visited.update(neighbors)
+            for sim, neighbor in zip(self.similarity(query, neighbors).tolist(), neighbors):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, neighbor))
+                    heapq.heappush(results, (sim, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def greedy_descend(self, query, level):
+        # walk from the entry point down to the given level with ef=1
+        entry_points = [self.entry_point]
+        for current in range(self.max_level, level, -1):
+            entry_points = [self.search_layer(query, entry_points, 1, current)[0][1]]
+        return entry_points
+
+    def insert(self, node):
+        self.ensure_loaded()
+        if node in self.levels:
+            return
+        query = np.asarray(self.vectors[node], dtype=np.float32)
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+        self.levels[node] = level
+        self.neighbors[node] = [[] for _ in range(level + 1)]
+        self.count += 1
+        if self.entry_point is None:
+            self.entry_point = node
+            self.max_level = level
+            return
+
+        entry_points = self.greedy_descend(query, level)
+        for current in range(min(level, self.max_level), -1, -1):
+            results = self.search_layer(query, entry_points, self.ef_construction, current)
+            selected = [neighbor for _, neighbor in results[:self.M]]
+            self.neighbors[node][current] = selected
+            # add reverse links and prune lists that became too long
+            for neighbor in selected:
+                links = self.neighbors[neighbor][current]
+                links.append(node)
+                if len(links) > self.max_links(current):
+                    sims = self.similarity(np.asarray(self.vectors[neighbor], dtype=np.float32), links)
+                    keep = np.argsort(-sims)[:self.max_links(current)]
+                    self.neighbors[neighbor][current] = [links[i] for i in keep]
+            entry_points = [neighbor for _, neighbor in results]
+        if level > self.max_level:
+            self.entry_point = node
+            self.max_level = level
+
+    def add_items(self, ids):
+        for node in ids:
+            self.insert(int(node))
+
+    def search(self, query, k=10):
+        # ids of the approximate nearest nodes of a normalized query, the best k of a beam of ef nodes
+        # so at most ef ids are returned, a larger ef gives better recall and slower search
+        self.ensure_loaded()
+        if self.entry_point is None:
+            return torch.zeros(0, dtype=torch.int64)
+        query = query.detach().float().cpu().numpy() if hasattr(query, 'detach') else np.asarray(query, dtype=np.float32)
+        entry_points = self.greedy_descend(query, 0)
+        results = self.search_layer(query, entry_points, self.ef, 0)
+        ids = [node for _, node in results][:k]
+        return torch.tensor(ids, dtype=torch.int64)
+
+    def save(self, folder):
+        self.ensure_loaded()
+        nodes = sorted(self.levels)
+        link_offsets = [0]
+        links = []
+        for node in nodes:
+            for level_links in self.neighbors[node]:
+                links.extend(level_links)
+                link_offsets.append(len(links))
+        tmp_path = os.path.join(folder, HNSW_INDEX_NAME + ".tmp.npz")
+        np.savez(tmp_path,
+                 count=np.array(len(nodes), dtype=np.int64),
+                 nodes=np.array(nodes, dtype=np.int64),
+                 levels=np.array([self.levels[node] for node in nodes], dtype=np.int64),
+                 link_offsets=np.array(link_offsets, dtype=np.int64),
+                 links=np.array(links, dtype=np.int64),
+                 entry_point=np.array(-1 if self.entry_point is None else self.entry_point, dtype=np.int64),
+                 max_level=np.array(self.max_level, dtype=np.int64),
+                 params=np.array([self.M, self.ef_construction], dtype=np.int64))
+        os.replace(tmp_path, os.path.join(folder, HNSW_INDEX_NAME))
+
+    @classmethod
+    def load(cls, folder, ef=64):
+        # only the node count is read here, the graph itself is loaded lazily on first use
+        path = os.path.join(folder, HNSW_INDEX_NAME)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            M, ef_construction = data['params'].tolist()
+            count = int(data['count'])
+        index = cls(M=M, ef_construction=ef_construction, ef=ef)
+        index.path = path
+        index.count = count
+        return index
+
+    def ensure_loaded(self):
+        if self.path is None:
+            return
+        with self.load_lock:
+            if self.path is not None:
+                self.load_graph()
+
+    def load_graph(self):
+        with np.load(self.path, allow_pickle=False) as data:
+            nodes = data['nodes'].tolist()
+            levels = data['levels'].tolist()
+            link_offsets = data['link_offsets'].tolist()
+            links = data['links'].tolist()
+            entry_point = int(data['entry_point'])
+            self.max_level = int(data['max_level'])
+        self.entry_point = None if entry_point < 0 else entry_point
+        position = 0
+        for node, level in zip(nodes, levels):
+            self.levels[node] = level
+            self.neighbors[node] = []
+            for _ in range(level + 1):
+                self.neighbors[node].append(links[link_offsets[position]:link_offsets[position + 1]])
+                position += 1
+        self.path = None
@@ -0,0 +1,116 @@
+import os
+import json
+import numpy as np
+
+# memory-mapped index format of a knowledge source, replaces the pickled contents_with_embed.pth
+#   index_header.json   : count, dim, dtype of the embedding matrix and the embedding model
+#   embedding.bin       : raw (count, dim) L2-normalized embedding matrix
+#   strings.bin         : utf-8 bytes of all meta strings followed by all content strings
+#   strings_offsets.bin : int64 byte offsets into strings.bin, 2 * count + 1 entries
+#   chunk_offsets.bin   : optional int64 (count, 2) character range of each chunk in the source text, -1 if it has none
+HEADER_NAME = "index_header.json"
+EMBEDDING_NAME = "embedding.bin"
+STRINGS_NAME = "strings.bin"
+OFFSETS_NAME = "strings_offsets.bin"
+CHUNK_OFFSETS_NAME = "chunk_offsets.bin"
+INDEX_VERSION = 1
+
+
+class StringTable():
+    # list-like read-only view of strings stored in a memory-mapped blob
+    def __init__(self, blob, offsets, start, count):
+        self.blob = blob
+        self.offsets = offsets
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError(f"string index out of range: {index}")
+        begin = int(self.offsets[self.start + index])
+        end = int(self.offsets[self.start + index + 1])
+        return bytes(self.blob[begin:end]).decode('utf-8')
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+
+def has_index(folder):
+    return os.path.exists(os.path.join(folder, HEADER_NAME))
+
+
+def save_index(contents_with_embed, folder, dtype="float16", model_type=None):
+    embedding = contents_with_embed['embedding']
+    if hasattr(embedding, 'detach'):
+        embedding = embedding.detach().cpu().numpy()
+    embedding = np.asarray(embedding, dtype=np.float32)
+    # a source without chunks (e.g. every page failed and there is no text) has no embedding dim, refuse it
+    if embedding.size == 0 or embedding.ndim != 2:
+        raise ValueError(f"No chunks to index in {folder}, embedding shape {embedding.shape}")
+    # store normalized vectors so search is a plain dot product
+    norms = np.linalg.norm(embedding, axis=-1, keepdims=True)
+    embedding = (embedding / np.maximum(norms, 1e-8)).astype(dtype)
+
+    strings = [str(item) for item in contents_with_embed['meta']] + [str(item) for item in contents_with_embed['content']]
+    encoded = [item.encode('utf-8') for item in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in encoded])
+
+    # write data files first and the header last, a folder without header is not a valid index
+    header_path = os.path.join(folder, HEADER_NAME)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    files = [(EMBEDDING_NAME, embedding.tobytes()), (STRINGS_NAME, b"".join(encoded)), (OFFSETS_NAME, offsets.tobytes())]
+    if contents_with_embed.get('offset') is not None:
+        chunk_offsets = np.array([item if item is not None else [-1, -1] for item in contents_with_embed['offset']], dtype=np.int64).reshape(-1, 2)
+        files.append((CHUNK_OFFSETS_NAME, chunk_offsets.tobytes()))
+    for name, data in files:
+        tmp_path = os.path.join(folder, name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(folder, name))
+    header = {'version': INDEX_VERSION,
+              'count': int(embedding.shape[0]),
+              'dim': int(embedding.shape[1]),
+              'dtype': str(embedding.dtype),
+              'normalized': True,
+              'chunk_offsets': contents_with_embed.get('offset') is not None,
+              'model': model_type}
+    with open(header_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(header, f, indent=4)
+    os.replace(header_path + ".tmp", header_path)
+
+
+def read_header(folder):
+    with open(os.path.join(folder, HEADER_NAME), 'r', encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_index(folder):
+    # open files with np.memmap, pages are loaded on demand and shared through the OS page cache
+    header = read_header(folder)
+    count, dim = header['count'], header['dim']
+    # copy-on-write mode gives a writable array without copying the file into memory
+    if count > 0:
+        embedding = np.memmap(os.path.join(folder, EMBEDDING_NAME), dtype=header['dtype'], mode='c', shape=(count, dim))
+    else:
+        # np.memmap cannot map an empty file
+        embedding = np.zeros((0, dim), dtype=header['dtype'])
+    offsets = np.memmap(os.path.join(folder, OFFSETS_NAME), dtype=np.int64, mode='r', shape=(2 * count + 1,))
+    if offsets[-1] > 0:
+        blob = np.memmap(os.path.join(folder, STRINGS_NAME), dtype=np.uint8, mode='r')
+    else:
+        blob = np.zeros(0, dtype=np.uint8)
+    index = {'meta': StringTable(blob, offsets, 0, count),
+             'content': StringTable(blob, offsets, count, count),
+             'embedding': embedding,
+             'normalized': header.get('normalized', False)}
+    if header.get('chunk_offsets', False) and count > 0:
+        index['offset'] = np.memmap(os.path.join(folder, CHUNK_OFFSETS_NAME), dtype=np.int64, mode='r', shape=(count, 2))
+    return index
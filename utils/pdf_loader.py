@@ -1,33 +1,77 @@
 # Imports
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from pdf2image.exceptions import (
     PDFInfoNotInstalledError,
     PDFPageCountError,
     PDFSyntaxError
 )
-from pdfminer.high_level import extract_text
+from pdfminer.high_level import extract_text, extract_pages
+from pdfminer.layout import LTTextContainer, LTFigure, LTImage, LTCurve
 import base64
 import io
 import os
+import difflib
+import hashlib
+import contextlib
+import concurrent.futures
 from tqdm import tqdm
+import openai
 from openai import OpenAI
 import re
 import pandas as pd 
 import json
 import numpy as np
+from PIL import Image
 from rich import print
 import time
 
 from prompts import IMAGE_ANALYZE_PROMPT
+from utils.rate_limiter import estimate_tokens
 
-def analyze_doc_image(img, model_type="gpt-4o"):
-    # turn image to base64 data
-    png_buffer = io.BytesIO()
-    img.save(png_buffer, format="PNG")
-    png_buffer.seek(0)
-    base64_png = base64.b64encode(png_buffer.read()).decode('utf-8')
-    data_uri = f"data:image/png;base64,{base64_png}"
+# tokens of one high detail page image plus the completion budget, used for the tokens per minute limit
+IMAGE_TOKENS = 765
+MAX_COMPLETION_TOKENS = 1000
+
+def encode_page_image(img, max_edge=0, image_format="PNG", quality=85, crop_margins=False, auto_grayscale=False):
+    # return the page as a base64 data uri, optionally cropped, downscaled, grayscale and lossy encoded
+    original = img
+    if crop_margins:
+        # crop near-white margins, keep a small border around the content
+        bbox = img.convert('L').point(lambda value: 255 if value < 245 else 0).getbbox()
+        if bbox is not None:
+            border = 8
+            img = img.crop((max(bbox[0] - border, 0), max(bbox[1] - border, 0), min(bbox[2] + border, img.width), min(bbox[3] + border, img.height)))
+    if auto_grayscale and img.mode != 'L':
+        # pages without colored pixels (text slides, scans) are sent in grayscale
+        rgb = np.asarray(img.convert('RGB'), dtype=np.int16)
+        if np.percentile(rgb.max(axis=-1) - rgb.min(axis=-1), 99) < 16:
+            img = img.convert('L')
+    if max_edge > 0 and max(img.size) > max_edge:
+        scale = max_edge / max(img.size)
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+
+    def encode(image, image_format):
+        buffer = io.BytesIO()
+        if image_format.upper() in ["JPEG", "JPG"]:
+            image.convert('L' if image.mode == 'L' else 'RGB').save(buffer, format="JPEG", quality=quality, optimize=True)
+            return buffer.getvalue(), "jpeg"
+        if image_format.upper() == "WEBP":
+            image.save(buffer, format="WEBP", quality=quality)
+            return buffer.getvalue(), "webp"
+        image.save(buffer, format="PNG")
+        return buffer.getvalue(), "png"
 
+    data, mime_type = encode(img, image_format)
+    if img is not original or mime_type != "png":
+        png_size = len(encode(original, "PNG")[0])
+        # clean vector pages can be smaller as png than as jpeg
+        if mime_type != "png" and len(data) >= png_size:
+            data, mime_type = encode(img, "PNG")
+        print(f"==> Page image {png_size / 1024:.0f} KB -> {len(data) / 1024:.0f} KB ({1 - len(data) / max(png_size, 1):.0%} saved)")
+    return f"data:image/{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+def describe_image(data_uri, model_type="gpt-4o"):
     # use openai to analyze image
     client = OpenAI()
     response = client.chat.completions.create(
@@ -46,7 +90,7 @@ def analyze_doc_image(img, model_type="gpt-4o"):
                 ]
                 },
         ],
-        max_tokens=1000,
+        max_tokens=MAX_COMPLETION_TOKENS,
         temperature=0,
         top_p=0.1
     )
@@ -54,24 +98,169 @@ def analyze_doc_image(img, model_type="gpt-4o"):
     return data
 
 
-def pdf_loader(file_name, file_path, model_type):    
-    doc = {"filename": file_name}
-    text = extract_text(file_path)
-    doc['text'] = text
+def analyze_doc_image(img, model_type="gpt-4o", image_options=None):
+    # turn image to base64 data
+    data_uri = encode_page_image(img, **(image_options or {}))
+    return describe_image(data_uri, model_type)
+
+
+def analyze_page(img, model_type, rate_limiter=None, max_retries=2, image_options=None, description_cache=None):
+    # retry api errors of one page, returns None if the page keeps failing so the document can go on
+    data_uri = encode_page_image(img, **(image_options or {}))
+    if description_cache is not None:
+        # pages seen before with the same prompt and model are not analyzed again
+        description = description_cache.get(model_type, IMAGE_ANALYZE_PROMPT, data_uri)
+        if description is not None:
+            return description
+    for attempt in range(max_retries + 1):
+        try:
+            if rate_limiter is not None:
+                # wait for the requests per minute (RPM) and tokens per minute (TPM) budget
+                description = rate_limiter.call(describe_image, data_uri, model_type, tokens=estimate_tokens(IMAGE_ANALYZE_PROMPT) + IMAGE_TOKENS + MAX_COMPLETION_TOKENS)
+            else:
+                description = describe_image(data_uri, model_type)
+            break
+        except openai.APIError as e:
+            if attempt == max_retries:
+                print(f"==> Failed to analyze page after {max_retries + 1} attempts: {e}")
+                return None
+            time.sleep(2 ** attempt)
+    if description_cache is not None and description is not None:
+        description_cache.put(model_type, IMAGE_ANALYZE_PROMPT, data_uri, description)
+    return description
+
+
+def classify_pages(file_path, min_chars=200, max_image_area=0.05, max_shapes=10):
+    # (text, needs vision) of every page from one pdfminer layout pass
+    # pages with little text (scans, diagrams), large pictures or many drawn lines and boxes (tables, charts) need vision
+    page_texts = []
+    needs_vision = []
+    for layout in extract_pages(file_path):
+        texts = []
+        image_area = 0.0
+        shapes = 0
+        for element in layout:
+            if isinstance(element, LTTextContainer):
+                texts.append(element.get_text())
+            elif isinstance(element, (LTFigure, LTImage)):
+                image_area += element.width * element.height
+            elif isinstance(element, LTCurve):
+                shapes += 1
+        page_text = "".join(texts)
+        page_texts.append(page_text)
+        needs_vision.append(len(page_text.strip()) < min_chars or image_area > max_image_area * layout.width * layout.height or shapes > max_shapes)
+    return page_texts, needs_vision
 
-    imgs = convert_from_path(file_path)
-    pages_description = []
-    print(f"Analyzing pages for doc {file_name}")
+
+def get_page_runs(pages, window):
+    # split sorted page numbers into runs of consecutive pages with at most window pages
+    runs = []
+    for page in pages:
+        if len(runs) > 0 and page == runs[-1][1] + 1 and page - runs[-1][0] < window:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return runs
+
+
+def run_in_pool(pool, func, *args, **kwargs):
+    # run func in the pool if there is one and wait for the result
+    if pool is None:
+        return func(*args, **kwargs)
+    return pool.submit(func, *args, **kwargs).result()
+
+
+def get_page_fingerprint(page_text, img=None):
+    # [text hash, image hash] of one page, pages that are not rendered (text pages) have no image hash
+    text_hash = hashlib.sha256(page_text.encode('utf-8')).hexdigest()[:16]
+    if img is None:
+        return [text_hash, None]
+    image_hash = hashlib.sha256(f"{img.mode} {img.size}".encode('utf-8') + img.tobytes()).hexdigest()[:16]
+    return [text_hash, image_hash]
+
+
+def diff_pages(old_fingerprints, new_fingerprints):
+    # number of added, removed and changed pages between two versions of a document
+    counts = {'added': 0, 'removed': 0, 'changed': 0, 'unchanged': 0}
+    matcher = difflib.SequenceMatcher(None, [tuple(item) for item in old_fingerprints], [tuple(item) for item in new_fingerprints], autojunk=False)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == 'equal':
+            counts['unchanged'] += new_end - new_start
+        elif tag == 'insert':
+            counts['added'] += new_end - new_start
+        elif tag == 'delete':
+            counts['removed'] += old_end - old_start
+        else:
+            changed = min(old_end - old_start, new_end - new_start)
+            counts['changed'] += changed
+            counts['added'] += new_end - new_start - changed
+            counts['removed'] += old_end - old_start - changed
+    return counts
+
+
+def pdf_loader(file_name, file_path, model_type, rate_limiter=None, workers=1, max_retries=2, dpi=200, grayscale=False, window=8, image_options=None, text_page_options=None,
+               executor=None, cpu_pool=None, position=None, description_cache=None, previous_doc=None):    
+    # when several files are loaded together they share a thread pool (executor) for page analysis
+    # and a process pool (cpu_pool) for layout extraction and rasterization
+    # with previous_doc (raw data of an earlier version), pages with the same fingerprint reuse their description
+    doc = {"filename": file_name}
+    if text_page_options is not None:
+        # text-only pages skip the vision model and use their extracted text as description
+        page_texts, needs_vision = run_in_pool(cpu_pool, classify_pages, file_path, **text_page_options)
+        doc['text'] = "".join(page_text + "\f" for page_text in page_texts)
+    else:
+        doc['text'] = run_in_pool(cpu_pool, extract_text, file_path)
+        needs_vision = [True] * pdfinfo_from_path(file_path)['Pages']
+        page_texts = doc['text'].split("\f")
+    num_pages = len(needs_vision)
+    page_texts = page_texts[:num_pages] + [""] * (num_pages - len(page_texts))
+    fingerprints = [get_page_fingerprint(page_texts[i]) for i in range(num_pages)]
+    reuse = {}
+    if previous_doc is not None and 'page_fingerprints' in previous_doc:
+        for i, (fingerprint, description) in enumerate(zip(previous_doc['page_fingerprints'], previous_doc['pages_description'])):
+            if fingerprint[1] is not None and i not in previous_doc.get('failed_pages', []):
+                reuse[tuple(fingerprint)] = description
+    vision_pages = [i + 1 for i in range(num_pages) if needs_vision[i]]
+    print(f"Analyzing {len(vision_pages)}/{num_pages} pages for doc {file_name}")
     
-    with tqdm(total=len(imgs)-1) as pbar:
-        for img in imgs:
-            # set sleep to avoid trigger tokens per minute (TPM) limit
-            time.sleep(1) 
-            res = analyze_doc_image(img, model_type)
-            pages_description.append(res)
+    # pages are rendered window by window and analyzed concurrently, descriptions stay in page order
+    # the next window is rendered while the previous one is analyzed, at most two windows of images are in memory
+    futures = {}
+    reused = 0
+    executor_context = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if executor is None else contextlib.nullcontext(executor)
+    with executor_context as executor, tqdm(total=len(vision_pages), desc=file_name, position=position) as pbar:
+        previous = []
+        for first_page, last_page in get_page_runs(vision_pages, window):
+            imgs = run_in_pool(cpu_pool, convert_from_path, file_path, dpi=dpi, grayscale=grayscale, first_page=first_page, last_page=last_page)
+            current = []
+            for page, img in zip(range(first_page, last_page + 1), imgs):
+                fingerprints[page - 1] = get_page_fingerprint(page_texts[page - 1], img)
+                if tuple(fingerprints[page - 1]) in reuse:
+                    # unchanged page of the previous version
+                    future = concurrent.futures.Future()
+                    future.set_result(reuse[tuple(fingerprints[page - 1])])
+                    current.append(future)
+                    reused += 1
+                else:
+                    current.append(executor.submit(analyze_page, img, model_type, rate_limiter, max_retries, image_options, description_cache))
+            del imgs
+            for future in concurrent.futures.as_completed(previous):
+                pbar.update(1)
+            futures.update(zip(range(first_page, last_page + 1), current))
+            previous = current
+        for future in concurrent.futures.as_completed(previous):
             pbar.update(1)
+        pages_description = [futures[i + 1].result() if needs_vision[i] else page_texts[i] for i in range(num_pages)]
+    doc['text_pages'] = [i for i in range(num_pages) if not needs_vision[i]]
+    doc['page_fingerprints'] = fingerprints
+    if reused > 0:
+        print(f"==> Reuse {reused}/{len(vision_pages)} page descriptions of the previous version of {file_name}")
     
-    doc['pages_description'] = pages_description
+    # failed pages get an empty description and are listed so they can be analyzed again
+    doc['failed_pages'] = [i for i, res in enumerate(pages_description) if res is None]
+    if len(doc['failed_pages']) > 0:
+        print(f"==> {len(doc['failed_pages'])} pages of {file_name} failed: {doc['failed_pages']}")
+    doc['pages_description'] = [res if res is not None else "" for res in pages_description]
     return doc
 
 #def pdf_page_loader(file_path):
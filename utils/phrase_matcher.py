@@ -0,0 +1,124 @@
+import os
+import re
+
+from utils.term_index import QUOTED_PATTERN, split_terms, load_raw_dict
+
+NUMBER_PATTERN = re.compile(r"\d")
+# words that may appear between standard phrases, digits are spoken one by one
+FILLER_WORDS = {"a", "an", "the", "to", "at", "on", "in", "of", "for", "from", "and", "is", "are", "i", "you", "we", "this", "that", "please",
+                "zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "niner"}
+
+
+class PhraseMatcher():
+    # word level aho-corasick automaton over standard radio phrases, scans an utterance in one pass
+    def __init__(self, phrases, end_phrases=None):
+        self.phrases = phrases              # list of phrases, each a tuple of lowercase words
+        self.names = []                     # display text of each phrase
+        self.goto = [{}]                    # state -> {word: next state}
+        self.fail = [0]
+        self.depth = [0]
+        self.output = [[]]                  # state -> ids of phrases ending here, longest first
+        self.prefix_of = [None]             # state -> id of a phrase that passes through the state
+        self.end_phrases = [tuple(split_terms(phrase.lower())) for phrase in (end_phrases or [])]
+        for phrase_id, phrase in enumerate(phrases):
+            state = 0
+            for word in phrase:
+                if word not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.output.append([])
+                    self.prefix_of.append(phrase_id)
+                    self.goto[state][word] = len(self.goto) - 1
+                state = self.goto[state][word]
+            self.output[state].append(phrase_id)
+        # breadth-first failure links, outputs of the failure state are inherited
+        queue = list(self.goto[0].values())
+        while len(queue) > 0:
+            state = queue.pop(0)
+            for word, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail != 0 and word not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(word, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    @classmethod
+    def build(cls, raw_dicts, end_phrases=None, max_words=4):
+        # raw_dicts maps source name -> list of raw items
+        # the phrase of an item is its first field, or its short other fields if that is a single letter (phonetics)
+        phrases = []
+        names = []
+        for items in raw_dicts.values():
+            for item in items:
+                if not isinstance(item, dict) or len(item) == 0:
+                    continue
+                values = [value for value in item.values() if isinstance(value, str)]
+                if len(values) == 0:
+                    continue
+                texts = QUOTED_PATTERN.findall(values[0]) or [values[0]]
+                if len(split_terms(values[0])) == 1 and len(split_terms(values[0])[0]) == 1:
+                    texts = [value for value in values[1:] if 0 < len(split_terms(value)) <= max_words]
+                for text in texts:
+                    # templates with blanks, e.g. "_ _ _ _ hrs", are not phrases
+                    if "_" in text:
+                        continue
+                    phrase = tuple(word.lower() for word in split_terms(text))
+                    if len(phrase) > 0 and phrase not in phrases:
+                        phrases.append(phrase)
+                        names.append(text.strip())
+        matcher = cls(phrases, end_phrases=end_phrases)
+        matcher.names = names
+        return matcher
+
+    @classmethod
+    def from_folder(cls, root_path, names, end_phrases=None):
+        raw_dicts = {name: load_raw_dict(os.path.join(root_path, name)) for name in names}
+        return cls.build({name: raw_dict for name, raw_dict in raw_dicts.items() if raw_dict is not None}, end_phrases=end_phrases)
+
+    def scan(self, words):
+        # (start, end, phrase id) of every full match and (start, end, phrase id) of every broken multi-word prefix
+        matches = []
+        partials = []
+        state = 0
+        for position, word in enumerate(words + [None]):
+            while state != 0 and (word is None or word not in self.goto[state]):
+                # a phrase was started with at least two words but not finished
+                if self.depth[state] >= 2 and len(self.output[state]) == 0:
+                    partials.append((position - self.depth[state], position, self.prefix_of[state]))
+                state = self.fail[state]
+            if word is None:
+                break
+            state = self.goto[state].get(word, 0)
+            for phrase_id in self.output[state]:
+                matches.append((position + 1 - len(self.phrases[phrase_id]), position + 1, phrase_id))
+        return matches, partials
+
+    def match(self, text):
+        # report matched phrases, partial phrases with their missing words and format problems of an utterance
+        tokens = split_terms(text)
+        words = [token.lower() for token in tokens]
+        matches, partials = self.scan(words)
+        covered = set(position for start, end, _ in matches for position in range(start, end))
+        # other words than standard phrases and fillers (names, places, free text) need the refine step
+        uncovered = [words[position] for position in range(len(words)) if position not in covered and words[position] not in FILLER_WORDS]
+        # end words alone do not make a message standard
+        standard = [phrase_id for _, _, phrase_id in matches if self.phrases[phrase_id] not in self.end_phrases]
+        partials = [(start, end, phrase_id) for start, end, phrase_id in partials if not set(range(start, end)) <= covered]
+        missing = [" ".join(self.phrases[phrase_id][end - start:]) for start, end, phrase_id in partials]
+        # letters must be spelled with the phonetic alphabet and numbers spoken digit by digit
+        letters = [token for token in tokens if len(token) == 1 and token.isupper() and token != "I"]
+        numbers = [token for token in tokens if NUMBER_PATTERN.search(token)]
+        ending = None
+        if len(self.end_phrases) > 0:
+            ending = next((phrase for phrase in self.end_phrases if len(phrase) > 0 and tuple(words[-len(phrase):]) == phrase), None)
+            if ending is None:
+                missing.append(" / ".join(" ".join(phrase) for phrase in self.end_phrases))
+        return {'matched': [self.names[phrase_id] for _, _, phrase_id in matches],
+                'partial': [self.names[phrase_id] for _, _, phrase_id in partials],
+                'missing': missing,
+                'letters': letters,
+                'numbers': numbers,
+                'uncovered': uncovered,
+                'conforms': len(standard) > 0 and len(uncovered) == 0 and len(partials) == 0 and len(missing) == 0 and len(letters) == 0 and len(numbers) == 0}
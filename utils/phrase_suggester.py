@@ -0,0 +1,91 @@
+from utils.term_index import TOKEN_PATTERN
+
+
+def edit_distance(a, b):
+    # character level levenshtein distance
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a):
+        current = [i + 1]
+        for j, char_b in enumerate(b):
+            current.append(min(previous[j + 1] + 1, current[j] + 1, previous[j] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+class BKTree():
+    # burkhard-keller tree, finds all items within an edit distance without comparing against every item
+    def __init__(self):
+        self.root = None        # (item, {distance: child node})
+
+    def add(self, item):
+        if self.root is None:
+            self.root = (item, {})
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(item, node[0])
+            if distance == 0:
+                return
+            if distance not in node[1]:
+                node[1][distance] = (item, {})
+                return
+            node = node[1][distance]
+
+    def search(self, item, tolerance):
+        # (distance, item) of all items within tolerance, closest first
+        results = []
+        nodes = [self.root] if self.root is not None else []
+        while len(nodes) > 0:
+            node = nodes.pop()
+            distance = edit_distance(item, node[0])
+            if distance <= tolerance:
+                results.append((distance, node[0]))
+            # triangle inequality, only children in [distance - tolerance, distance + tolerance] can match
+            nodes.extend(child for child_distance, child in node[1].items() if distance - tolerance <= child_distance <= distance + tolerance)
+        return sorted(results)
+
+
+class PhraseSuggester():
+    # replaces near-miss spellings of standard phrases in an utterance, e.g. "rodger" -> "Roger"
+    def __init__(self, phrase_matcher, max_edit_ratio=0.2):
+        self.phrase_matcher = phrase_matcher
+        self.max_edit_ratio = max_edit_ratio
+        self.max_len = max([len(phrase) for phrase in phrase_matcher.phrases], default=0)
+        self.names = {}
+        self.tree = BKTree()
+        for phrase, name in zip(phrase_matcher.phrases, phrase_matcher.names):
+            self.names.setdefault(" ".join(phrase), name)
+            self.tree.add(" ".join(phrase))
+
+    def suggest(self, text):
+        # return (suggested text, confidence), confidence is 0 if the suggestion still does not conform
+        spans = [match.span() for match in TOKEN_PATTERN.finditer(text)]
+        words = [text[begin:end].replace('.', '').lower() for begin, end in spans]
+        candidates = []
+        for start in range(len(words)):
+            for length in range(1, min(self.max_len + 1, len(words) - start) + 1):
+                window = " ".join(words[start:start + length])
+                tolerance = int(len(window) * self.max_edit_ratio)
+                for distance, phrase in self.tree.search(window, tolerance)[:1]:
+                    candidates.append((distance / max(len(phrase), 1), -length, start, length, distance, phrase))
+        # keep the closest non-overlapping corrections
+        covered = set()
+        corrections = []
+        for _, _, start, length, distance, phrase in sorted(candidates):
+            if covered.isdisjoint(range(start, start + length)):
+                covered.update(range(start, start + length))
+                corrections.append((start, length, distance, phrase))
+        # replace the corrected words in the original text, punctuation is kept
+        suggestion = text
+        for start, length, distance, phrase in sorted(corrections, reverse=True):
+            if distance == 0:
+                continue
+            suggestion = suggestion[:spans[start][0]] + self.names[phrase] + suggestion[spans[start + length - 1][1]:]
+
+        if not self.phrase_matcher.match(suggestion)['conforms']:
+            return suggestion, 0.0
+        total_distance = sum(distance for _, _, distance, _ in corrections)
+        total_length = sum(len(phrase) for _, _, _, phrase in corrections)
+        return suggestion, 1.0 - total_distance / max(total_length, 1)
@@ -0,0 +1,44 @@
+import torch
+
+# torch._int_mm is a private op, disabled after the first failure
+_INT_MM = {'enabled': hasattr(torch, '_int_mm')}
+
+
+def quantize_int8(blocks, chunk_size=4096):
+    # per-dimension symmetric int8 quantization of a list of (n, dim) embedding blocks
+    # returns codes (total_n, dim) int8 and scale (dim,) float32 so that x ~= codes * scale
+    absmax = None
+    for block in blocks:
+        for start in range(0, block.shape[0], chunk_size):
+            chunk_max = block[start:start + chunk_size].float().abs().amax(dim=0)
+            absmax = chunk_max if absmax is None else torch.maximum(absmax, chunk_max)
+    scale = torch.clamp(absmax / 127.0, min=1e-12)
+
+    codes = []
+    for block in blocks:
+        for start in range(0, block.shape[0], chunk_size):
+            chunk = block[start:start + chunk_size].float().to(scale.device)
+            codes.append(torch.clamp(torch.round(chunk / scale), -127, 127).to(torch.int8))
+    return torch.cat(codes, dim=0), scale
+
+
+def int8_scores(codes, scaled_query, chunk_size=4096):
+    # approximate dot products between int8 codes and a query already multiplied by the scale
+    # the query is quantized to int8 too and the products are accumulated in int32 (3072 * 127 * 127 fits)
+    query_scale = torch.clamp(scaled_query.abs().max() / 127.0, min=1e-12)
+    query_codes = torch.clamp(torch.round(scaled_query / query_scale), -127, 127).to(torch.int8)
+    # _int_mm needs a matrix on the right, the query is repeated over 8 columns
+    query_codes = query_codes.reshape(-1, 1).expand(-1, 8).contiguous()
+    scores = []
+    for start in range(0, codes.shape[0], chunk_size):
+        chunk = codes[start:start + chunk_size]
+        if _INT_MM['enabled']:
+            try:
+                scores.append(torch._int_mm(chunk, query_codes)[:, 0].float() * query_scale)
+                continue
+            except (AttributeError, RuntimeError, NotImplementedError) as e:
+                # older torch or unsupported device/shape, fall back to float for the rest of the process
+                print(f"==> int8 matmul unavailable ({type(e).__name__}), widen int8 codes to float32")
+                _INT_MM['enabled'] = False
+        scores.append(torch.mv(chunk.float(), scaled_query))
+    return torch.cat(scores, dim=0)
@@ -0,0 +1,91 @@
+import time
+import random
+import threading
+import openai
+
+# shared limiters, one per model name, so every caller in the process draws from the same quota
+# openai quotas are per model, roles (MODEL_TYPES keys) that use the same model share one limiter with the lowest budget
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def estimate_tokens(text):
+    # rough token count for budgeting, about 4 characters per token for english text
+    return max(1, len(text) // 4)
+
+
+class TokenBucket():
+    # refills continuously at capacity per minute, the balance may go negative to reserve future capacity
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        # take amount now and return how long the caller has to wait until it is covered
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter():
+    # requests per minute and tokens per minute budget of one model, backs off on 429 responses
+    def __init__(self, rpm=500, tpm=30000, max_retries=6, backoff=2.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now), self.paused_until - now)
+        if wait > 0:
+            time.sleep(wait)
+
+    def limit(self, rpm, tpm):
+        # lower the budget to at most rpm / tpm
+        with self.lock:
+            for bucket, per_minute in [(self.requests, rpm), (self.tokens, tpm)]:
+                if per_minute < bucket.capacity:
+                    bucket.capacity = float(per_minute)
+                    bucket.rate = bucket.capacity / 60.0
+                    bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+    def pause(self, seconds):
+        # a 429 means the real quota is lower than the budget, hold every caller of this model
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def call(self, func, *args, tokens=1, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens)
+            try:
+                return func(*args, **kwargs)
+            except openai.RateLimitError as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.response.headers.get('retry-after') if e.response is not None else None
+                delay = float(retry_after) if retry_after else self.backoff * 2 ** attempt * (1 + random.random())
+                print(f"==> Rate limited, retry in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                self.pause(delay)
+
+
+def get_rate_limiter(config, model_key):
+    # model_key is a key of MODEL_TYPES, e.g. PDF_ANALYZE_MODEL, budgets are read from RATE_LIMIT
+    model_type = config['MODEL_TYPES'][model_key]
+    limit_config = config.get('RATE_LIMIT', {})
+    budget = limit_config.get(model_key, {})
+    rpm, tpm = budget.get('RPM', 500), budget.get('TPM', 30000)
+    with _LIMITERS_LOCK:
+        if model_type not in _LIMITERS:
+            _LIMITERS[model_type] = RateLimiter(rpm=rpm, tpm=tpm, max_retries=limit_config.get('MAX_RETRIES', 6))
+        limiter = _LIMITERS[model_type]
+        if rpm != limiter.requests.capacity or tpm != limiter.tokens.capacity:
+            print(f"==> {model_key} shares the rate limit of {model_type} with another role, use RPM {min(rpm, limiter.requests.capacity):.0f} TPM {min(tpm, limiter.tokens.capacity):.0f}")
+            limiter.limit(rpm, tpm)
+        return limiter
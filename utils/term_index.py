@@ -0,0 +1,97 @@
+import os
+import re
+import json
+
+RAW_DICT_NAME = "raw_dict.json"
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+(?:[.'][A-Za-z0-9]+)*")
+QUOTED_PATTERN = re.compile(r'["“]([^"”]+)["”]')
+
+
+def split_terms(text):
+    # case-preserving tokens with dots removed, "A.C." and "AC" give the same term
+    return [token.replace('.', '') for token in TOKEN_PATTERN.findall(str(text))]
+
+
+def load_raw_dict(folder):
+    # return None if the folder has no raw dictionary, e.g. a manual of the database
+    path = os.path.join(folder, RAW_DICT_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding="utf-8") as f:
+        raw_dict = json.load(f)
+    return raw_dict if isinstance(raw_dict, list) else None
+
+
+class TermIndex():
+    # hashed lookup of dictionary terms (acronyms, words, catch phrases) found verbatim in an utterance
+    def __init__(self, terms, cased_terms, max_len):
+        self.terms = terms                  # lowercase term tuple -> list of (source name, item index)
+        self.cased_terms = cased_terms      # lowercase term tuple -> term tuple that must match with case, or None if any capital is enough
+        self.max_len = max_len              # longest term in tokens
+
+    @classmethod
+    def build(cls, raw_dicts, max_words=4, skip_terms=()):
+        # raw_dicts maps source name -> list of raw items, item i is row i of the source
+        # skip_terms are lowercase terms that are never looked up, e.g. the end words "over" and "out"
+        # the first field of an item is its term, short other fields (definitions, phonetics) are terms too
+        # acronyms that are also plain words of the dictionary text, like "IT", only match in capitals,
+        # short acronyms like "MAP" or "NEW" do not match all-lowercase words
+        vocabulary = set()
+        for items in raw_dicts.values():
+            for item in items:
+                if isinstance(item, dict):
+                    vocabulary.update(token for value in item.values() if isinstance(value, str) for token in split_terms(value) if token.islower())
+        terms = {}
+        cased_terms = {}
+        for name, items in raw_dicts.items():
+            for index, item in enumerate(items):
+                if not isinstance(item, dict) or len(item) == 0:
+                    continue
+                values = list(item.values())
+                if not isinstance(values[0], str):
+                    continue
+                texts = QUOTED_PATTERN.findall(values[0]) or [values[0]]
+                texts += [value for value in values[1:] if isinstance(value, str) and 0 < len(split_terms(value)) <= max_words]
+                for text in texts:
+                    term = tuple(split_terms(text))
+                    # single letters and digits match almost every utterance
+                    if len(term) == 0 or (len(term) == 1 and len(term[0]) < 2):
+                        continue
+                    key = tuple(token.lower() for token in term)
+                    if key in skip_terms:
+                        continue
+                    if len(term) == 1 and term[0].isupper() and key[0] in vocabulary:
+                        cased_terms[key] = term
+                    elif len(term) == 1 and term[0].isupper() and len(term[0]) <= 3:
+                        cased_terms.setdefault(key, None)
+                    if (name, index) not in terms.setdefault(key, []):
+                        terms[key].append((name, index))
+        max_len = max([len(key) for key in terms], default=0)
+        return cls(terms, cased_terms, max_len)
+
+    def match_case(self, key, term):
+        if key not in self.cased_terms:
+            return True
+        if self.cased_terms[key] is None:
+            return not term[0].islower()
+        return term == self.cased_terms[key]
+
+    def lookup(self, text):
+        # (source name, item index) of all terms in the text, leftmost longest match first
+        tokens = split_terms(text)
+        keys = [token.lower() for token in tokens]
+        hits = []
+        start = 0
+        while start < len(tokens):
+            length = min(self.max_len, len(tokens) - start)
+            while length > 0:
+                key = tuple(keys[start:start + length])
+                if key in self.terms and self.match_case(key, tuple(tokens[start:start + length])):
+                    break
+                length -= 1
+            if length == 0:
+                start += 1
+                continue
+            hits.extend(hit for hit in self.terms[key] if hit not in hits)
+            start += length
+        return hits